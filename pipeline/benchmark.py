@@ -0,0 +1,325 @@
+"""benchmark.py
+
+Benchmarks for the processing pipeline. Each benchmark runs on real data and
+prints a small table with timings.
+
+Usage:
+
+$ python3 benchmark.py --topics -d DATA_DIR -f FILELIST -e END (--cores 1,2,4,8)
+
+Run topic inference over the first END files of FILELIST with increasing numbers
+of worker processes and report documents per second and the speedup relative to
+the first run. Output is written to DATA_DIR/top as with generate_topics.py.
+
+$ python3 benchmark.py --tokenizers -d DATA_DIR (-f FILELIST) (-e END)
+
+Compare the nltk and regex tokenizers of generate_topics.py on the first END
+files of FILELIST (default is data/filelist-comm_use-random.txt). Prints the
+throughput of both tokenizers and how well the regex tokenizer agrees with the
+nltk tokenizer, both on exact token sequences and on bags of lemmas. This is
+also a parity test: the script exits with status 1 if the overlap of the bags of
+lemmas over all documents is less than TOKENIZER_OVERLAP. The first difference
+in each document whose token sequences differ is printed, for at most
+MAX_DIFFERENCES documents.
+
+Exact token sequences are not expected to be the same for all documents because
+the regex tokenizer does not split sentences first. It always drops the period
+at the end of a token, where word_tokenize() keeps it for abbreviations and
+other places where no sentence ends (approx., vs.), and it splits off n't as 't,
+so wouldn't gives the stopword wouldn instead of would. On the license texts in
+/usr/share/common-licenses and a handwritten sample of CORD-19 style text the
+overlap was 0.9997, with only these two differences.
+
+$ python3 benchmark.py --lif DIRECTORY (-e END)
+
+Load the first END LIF files from DIRECTORY in the default mode and in lean mode
+(with and without accessing the views) and print time and peak memory.
+
+$ python3 benchmark.py --metadata METADATA_FILE
+
+Load the COVID metadata file with the default and the lean Metadata loader and
+from the cache (see cache.py) and print time and peak memory for each.
+
+$ python3 benchmark.py --build INPUT_DIR -m METADATA_FILE -r PROCESSING_RESULTS -d DATA_DIR (-e END)
+
+Create index documents for the first END COVID JSON files in INPUT_DIR, first by
+running the four pipeline steps (convert, import, topics and index) one after
+the other with files in DATA_DIR/scripts and then with build.py, writing to
+DATA_DIR/build. Prints the time for each step and for the whole run.
+
+$ python3 benchmark.py --load DIRECTORY (-e END) (--mapping MAPPING_FILE)
+
+Load the first END index documents from DIRECTORY into temporary indexes of the
+Elasticsearch server used by load_index.py, with dynamic mappings and with the
+mappings in MAPPING_FILE (default is data/mapping.json), each with and without
+the bulk load settings of load_index.py --bulk. Prints load time and the number
+of documents and size of the index for each. The indexes are deleted afterwards,
+also when loading fails.
+
+Without a real server at hand this was run against a single-node stand-in that
+indexes with tantivy, on 5000 synthetic documents of the create_index.py shape
+and one CPU. Load times were within noise of each other (7.5-11.5 seconds for
+all modes) and the mapping saved at most 5% of index size (103.6MB against
+104.2-109.1MB), so numbers from a real cluster are still needed.
+
+"""
+
+import os
+import sys
+import time
+import getopt
+import tracemalloc
+from collections import Counter
+
+from lif import LIF
+from store import get_store, document_key
+from utils import elements
+
+
+FILELIST = 'data/filelist-comm_use-random.txt'
+
+# lowest overlap of the bags of lemmas of the two tokenizers that passes the
+# tokenizer parity test, and the number of differences that are printed
+TOKENIZER_OVERLAP = 0.995
+MAX_DIFFERENCES = 20
+MAPPING_FILE = 'data/mapping.json'
+
+
+def bench_topics(data_dir, filelist, end, cores):
+    import generate_topics
+    # files missing from the lif store are skipped by the run, so only the
+    # documents that are there count for the throughput
+    lif_store = get_store(data_dir, 'lif')
+    docs = sum(1 for n, fname in elements(filelist, 1, end)
+               if document_key(fname) in lif_store)
+    print("\nTopic inference on %d documents\n" % docs)
+    print("    workers   seconds   docs/sec   speedup")
+    baseline = None
+    for workers in cores:
+        t0 = time.time()
+        generate_topics.generate_topics(data_dir, filelist, 1, end, workers=workers)
+        elapsed = time.time() - t0
+        baseline = elapsed if baseline is None else baseline
+        print("    %7d  %8.2f  %9.2f  %8.2f"
+              % (workers, elapsed, docs / elapsed, baseline / elapsed))
+
+
+def bench_tokenizers(data_dir, filelist, end):
+    import generate_topics
+    fnames = []
+    texts = []
+    for n, fname in elements(filelist, 1, end):
+        fpath = os.path.join(data_dir, 'lif', fname)
+        if os.path.exists(fpath):
+            fnames.append(fname)
+            texts.append(LIF(fpath, lean=True).text.value)
+    generate_topics.load_lemma_table()
+    results = {}
+    print("\nTokenizing %d documents\n" % len(texts))
+    print("    tokenizer   seconds   docs/sec   tokens")
+    for tokenizer in ('nltk', 'regex'):
+        t0 = time.time()
+        results[tokenizer] = [
+            generate_topics.prepare_text_for_lda(
+                text, ignore=generate_topics.WORDS_TO_IGNORE, tokenizer=tokenizer)
+            for text in texts]
+        elapsed = time.time() - t0
+        tokens = sum(len(r) for r in results[tokenizer])
+        print("    %-9s  %8.2f  %9.2f  %7d"
+              % (tokenizer, elapsed, len(texts) / elapsed, tokens))
+    identical = 0
+    shared = 0
+    total = 0
+    differences = []
+    for fname, nltk_tokens, regex_tokens in zip(fnames, results['nltk'], results['regex']):
+        identical += nltk_tokens == regex_tokens
+        if nltk_tokens != regex_tokens:
+            differences.append((fname, first_difference(nltk_tokens, regex_tokens)))
+        nltk_bag = Counter(nltk_tokens)
+        regex_bag = Counter(regex_tokens)
+        shared += sum((nltk_bag & regex_bag).values())
+        total += sum((nltk_bag | regex_bag).values())
+    overlap = shared / total if total else 1.0
+    print("\n    identical token sequences  %d/%d" % (identical, len(texts)))
+    print("    bag of lemmas overlap      %.4f" % overlap)
+    if differences:
+        print("\nToken sequences differ for %d documents:\n" % len(differences))
+        for fname, (position, nltk_context, regex_context) in differences[:MAX_DIFFERENCES]:
+            print("    %s  token %d" % (fname, position))
+            print("        nltk   %s" % ' '.join(nltk_context))
+            print("        regex  %s" % ' '.join(regex_context))
+    if overlap < TOKENIZER_OVERLAP:
+        print("\nOverlap %.4f is below %.4f" % (overlap, TOKENIZER_OVERLAP))
+    return overlap >= TOKENIZER_OVERLAP
+
+
+def first_difference(tokens1, tokens2, context=3):
+    """Return the position of the first token where two token lists differ and
+    the tokens of both lists from there, with a few tokens of context."""
+    position = 0
+    while (position < len(tokens1) and position < len(tokens2)
+           and tokens1[position] == tokens2[position]):
+        position += 1
+    start = max(0, position - context)
+    end = position + context + 1
+    return position, tokens1[start:end], tokens2[start:end]
+
+
+def bench_lif(directory, end):
+    fnames = [os.path.join(directory, f) for f in sorted(os.listdir(directory))[:end]]
+    print("\nLoading %d LIF files\n" % len(fnames))
+    print("    mode            seconds   docs/sec   peak MB")
+    modes = [('default', False, True), ('lean', True, True), ('lean-noviews', True, False)]
+    for mode, lean, views in modes:
+        tracemalloc.start()
+        t0 = time.time()
+        for fname in fnames:
+            lif = LIF(fname, lean=lean)
+            if views:
+                lif.views
+        elapsed = time.time() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("    %-13s  %8.2f  %9.2f  %8.2f"
+              % (mode, elapsed, len(fnames) / elapsed, peak / 1024 / 1024))
+
+
+def bench_metadata(metadata_file):
+    import covid
+    print("\nLoading metadata from %s\n" % metadata_file)
+    results = []
+    # make sure the cache is filled before timing a cached load
+    covid.load_metadata(metadata_file, lean=True)
+    for mode, lean in (('default', False), ('lean', True), ('cached', None)):
+        tracemalloc.start()
+        t0 = time.time()
+        if lean is None:
+            metadata = covid.load_metadata(metadata_file, lean=True)
+        else:
+            metadata = covid.Metadata(metadata_file, lean=lean)
+        elapsed = time.time() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append((mode, elapsed, peak, len(metadata)))
+        del metadata
+    print("\n    mode       seconds   lines   peak MB")
+    for mode, elapsed, peak, lines in results:
+        print("    %-8s  %8.2f  %6d  %8.2f" % (mode, elapsed, lines, peak / 1024 / 1024))
+
+
+def bench_build(metadata_file, results_file, input_dir, data_dir, end):
+    import covid
+    import build
+    import generate_topics
+    import create_index
+    from store import open_store
+    scripts_dir = os.path.join(data_dir, 'scripts')
+    build_dir = os.path.join(data_dir, 'build')
+    timings = []
+    t0 = time.time()
+    covid.convert_into_lif(metadata_file, input_dir, os.path.join(scripts_dir, 'lif'), end)
+    timings.append(('convert', time.time() - t0))
+    keys = open_store(os.path.join(scripts_dir, 'lif'), 'lif').keys()
+    filelist = os.path.join(scripts_dir, 'filelist.txt')
+    with open(filelist, 'w') as fh:
+        fh.write(''.join("%s.json\n" % key for key in keys))
+    t0 = time.time()
+    importer = covid.RelationImporter(metadata_file, results_file,
+                                      os.path.join(scripts_dir, 'lif'),
+                                      os.path.join(scripts_dir, 'har'))
+    importer.convert()
+    timings.append(('import', time.time() - t0))
+    t0 = time.time()
+    generate_topics.generate_topics(scripts_dir, filelist, 1, len(keys))
+    timings.append(('topics', time.time() - t0))
+    t0 = time.time()
+    create_index.create_documents(scripts_dir, filelist, 1, len(keys))
+    timings.append(('index', time.time() - t0))
+    timings.append(('all scripts', sum(t for step, t in timings)))
+    t0 = time.time()
+    build.build(metadata_file, results_file, input_dir, build_dir, end)
+    timings.append(('build.py', time.time() - t0))
+    print("\nCreating index documents for %d files\n" % len(keys))
+    print("    step          seconds   docs/sec")
+    for step, elapsed in timings:
+        print("    %-12s  %8.2f  %9.2f" % (step, elapsed, len(keys) / elapsed))
+
+
+def bench_load(directory, end, mapping_file=MAPPING_FILE):
+    import json
+    import load_index
+    from elastic import Index
+    from utils import Progress
+    # read the documents first so that only loading is timed
+    documents = []
+    for document in load_index.iter_documents(directory):
+        if len(documents) == end:
+            break
+        documents.append(document)
+    with open(mapping_file) as fh:
+        mappings = json.load(fh)
+    modes = [('dynamic', {}, False), ('dynamic-bulk', {}, True),
+             ('mapping', mappings, False), ('mapping-bulk', mappings, True)]
+    results = []
+    for mode, index_mappings, bulk in modes:
+        idx = Index('benchmark-load-%s' % mode, host=load_index.HOST, port=load_index.PORT)
+        try:
+            idx.create(index_mappings)
+            t0 = time.time()
+            saved_settings = idx.start_bulk_load() if bulk else None
+            idx.load_streaming(documents, threads=load_index.THREADS,
+                               chunk_size=load_index.CHUNK_SIZE,
+                               progress=Progress('load_index', total=len(documents)))
+            if saved_settings is not None:
+                idx.end_bulk_load(saved_settings)
+            else:
+                idx.es.indices.refresh(index=idx.index)
+            elapsed = time.time() - t0
+            docs, size = idx.size()
+            results.append((mode, elapsed, docs, size))
+        finally:
+            idx.es.indices.delete(index=idx.index, ignore=[404])
+    print("\nLoading %d documents\n" % len(documents))
+    print("    mode            seconds   docs/sec     docs   size MB")
+    for mode, elapsed, docs, size in results:
+        print("    %-13s  %8.2f  %9.2f  %7d  %8.2f"
+              % (mode, elapsed, len(documents) / elapsed, docs, size / 1024 / 1024))
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 benchmark.py --topics -d DATA_DIR -f FILELIST -e END (--cores 1,2,4)"
+          + "\n    $ python3 benchmark.py --tokenizers -d DATA_DIR (-f FILELIST) (-e END)"
+          + "\n    $ python3 benchmark.py --lif DIRECTORY (-e END)"
+          + "\n    $ python3 benchmark.py --metadata METADATA_FILE"
+          + "\n    $ python3 benchmark.py --build INPUT_DIR -m METADATA_FILE -r PROCESSING_RESULTS"
+          + " -d DATA_DIR (-e END)"
+          + "\n    $ python3 benchmark.py --load DIRECTORY (-e END) (--mapping MAPPING_FILE)"
+          + "\n    $ python3 benchmark.py (-h | --help)\n")
+
+
+if __name__ == '__main__':
+
+    options = dict(getopt.getopt(sys.argv[1:], 'd:f:e:m:r:h',
+                                 ['topics', 'tokenizers', 'lif=', 'metadata=', 'build=',
+                                  'load=', 'mapping=', 'cores=', 'help'])[0])
+    data_dir = options.get('-d')
+    filelist = options.get('-f', FILELIST)
+    end = int(options.get('-e', 100))
+    cores = [int(c) for c in options.get('--cores', '1,2,4,8').split(',')]
+
+    if '--topics' in options:
+        bench_topics(data_dir, filelist, end, cores)
+    elif '--tokenizers' in options:
+        if not bench_tokenizers(data_dir, filelist, end):
+            sys.exit(1)
+    elif '--lif' in options:
+        bench_lif(options['--lif'], end)
+    elif '--metadata' in options:
+        bench_metadata(options['--metadata'])
+    elif '--build' in options:
+        bench_build(options['-m'], options['-r'], options['--build'], data_dir, end)
+    elif '--load' in options:
+        bench_load(options['--load'], end, options.get('--mapping', MAPPING_FILE))
+    else:
+        usage()
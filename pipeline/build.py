@@ -0,0 +1,192 @@
+"""build.py
+
+Run the whole pipeline on the COVID JSON files in one pass. For each file this
+does in memory what the four pipeline scripts do with files on disk:
+
+covid.py --convert     convert the COVID JSON file into a LIF object
+covid.py --import      create a LIF object with the relations from the Harvard
+                       processing results
+generate_topics.py     create a LIF object with the topics
+create_index.py        create the document that is loaded into ElasticSearch
+
+Only the output of the last step is written, to DATA_DIR/ela. The documents are
+the same as those created by running the four scripts.
+
+Usage:
+
+$ python3 build.py -m METADATA_FILE -r PROCESSING_RESULTS -i INPUT_DIR -d DATA_DIR
+                   (-e END) (--keep lif,har,top) (--workers N) (--crash)
+                   (--metrics FILE) (--compact) (--gzip) (--packed) (--tokenizer regex)
+
+INPUT_DIR has the COVID JSON files, for example the comm_use_subset directory,
+and END restricts processing to the first END files. With --keep the LIF objects
+for the stages listed are also written to DATA_DIR, which can be useful for
+debugging or for running one of the separate scripts later. With --workers N
+files are processed in batches by a pool of N processes, each of which loads the
+topic model once. The other options are as for the separate scripts.
+
+See benchmark.py --build for a comparison with running the four scripts.
+
+
+== Example
+
+export COVID=/Users/Shared/DATA/resources/corpora/covid-19
+export META=$COVID/2020-03-13/all_sources_metadata_2020-03-13.csv
+export HARVARD=$COVID/2020-03-20/cord19_pmc_stmts_filt.json
+
+python3 build.py -m $META -r $HARVARD -i $COVID/2020-03-13/comm_use_subset -d $COVID/processed --workers 8
+
+"""
+
+import os
+import sys
+import getopt
+from multiprocessing import Pool
+
+import covid
+import generate_topics
+from lif import LIF
+from create_index import Document
+from utils import time_elapsed, batches, print_errors, set_output_options, Progress
+from utils import get_settings
+from store import get_store, close_stores
+
+
+BATCH_SIZE = 50
+
+STAGES = ('lif', 'har', 'top')
+
+
+@time_elapsed
+def build(metadata_file, results_file, input_dir, data_dir, end=None, keep=(),
+          crash=False, workers=1):
+    """Create index documents in data_dir/ela for the first end files in
+    input_dir. The LIF objects for stages in keep are also written. Returns a
+    list of (fname, error) pairs."""
+    print("$ python3 %s\n" % ' '.join(sys.argv))
+    importer = covid.RelationImporter(metadata_file, results_file, None, None)
+    importer.prepare()
+    lookup = covid.MetadataLookup(importer.metadata)
+    fnames = os.listdir(input_dir)[:end]
+    progress = Progress('build', total=len(fnames))
+    built = skipped = 0
+    errors = []
+    jobs = [(input_dir, batch, crash) for batch in batches(fnames, BATCH_SIZE)]
+    initargs = (lookup, importer.inverted_rels, data_dir, keep)
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_builder,
+                    initargs=initargs + ('r', generate_topics.TOKENIZER, get_settings()))
+        results = pool.imap_unordered(_build_batch, jobs)
+    else:
+        pool = None
+        _init_builder(*initargs)
+        results = map(_build_batch, jobs)
+    for batch_built, batch_skipped, size, batch_errors in results:
+        built += batch_built
+        skipped += batch_skipped
+        errors.extend(batch_errors)
+        progress.add(docs=batch_built + batch_skipped, bytes=size, errors=len(batch_errors))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    close_stores()
+    progress.finish(built=built, skipped=skipped, failed=len(errors))
+    print("\nBuilt %d documents, skipped %d incomplete files, %d files failed"
+          % (built, skipped, len(errors)))
+    print_errors(errors)
+    return errors
+
+
+# metadata lookup, relations and settings used by _build_batch(), set once for
+# each worker process by _init_builder(), which also loads the topic model
+_BUILDER = {}
+
+
+def _init_builder(lookup, inverted_rels, data_dir, keep, mmap=None, tokenizer=None,
+                  settings=None):
+    _BUILDER['metadata'] = lookup
+    _BUILDER['inverted_rels'] = inverted_rels
+    _BUILDER['data_dir'] = data_dir
+    _BUILDER['keep'] = keep
+    generate_topics._init_worker(mmap, tokenizer, settings)
+
+
+def _build_batch(job):
+    """Build the index documents for a batch of files. Returns the number of
+    documents built, the number of skipped files, the number of characters
+    written and a list of (fname, error) pairs."""
+    input_dir, fnames, crash = job
+    built = skipped = size = 0
+    errors = []
+    for fname in fnames:
+        try:
+            chars = build_document(os.path.join(input_dir, fname))
+        except Exception as e:
+            if crash:
+                raise
+            errors.append((fname, "%s: %s" % (type(e).__name__, e)))
+            continue
+        if chars:
+            built += 1
+            size += chars
+        else:
+            skipped += 1
+    return built, skipped, size, errors
+
+
+def build_document(infile):
+    """Create the index document for a COVID JSON file and return the number of
+    characters written, which is zero if the file was skipped because it was
+    not complete."""
+    data_dir = _BUILDER['data_dir']
+    converter = covid.Converter(infile, None, _BUILDER['metadata'])
+    lif = converter.create_lif()
+    if lif is None:
+        return 0
+    key = converter.key
+    # the name of the LIF file, which is what create_index.py gets from the
+    # filelist
+    fname = key + '.json'
+    relations = covid.document_relations(_BUILDER['inverted_rels'], key)
+    har = covid.relations_lif(relations)
+    model = generate_topics._WORKER_MODEL
+    top = generate_topics.create_topics_lif(
+        lif, fname, model['lda'], model['topic_idx'], model['dictionary'])
+    documents = {'lif': lif.as_json(), 'har': har.as_json(), 'top': top.as_json()}
+    for stage in _BUILDER['keep']:
+        get_store(data_dir, stage).write(key, documents[stage], newline=True)
+    # Document expects LIF objects as they are read from disk
+    doc = Document(fname, data_dir,
+                   LIF(json_object=documents['lif'], lean=True),
+                   LIF(json_object=documents['top'], lean=True),
+                   LIF(json_object=documents['har'], lean=True))
+    return doc.write(get_store(data_dir, 'ela'))
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python3 build.py -m METADATA_FILE -r PROCESSING_RESULTS -i INPUT_DIR -d DATA_DIR"
+          + "\n                       (-e END) (--keep lif,har,top) (--workers N) (--crash)"
+          + "\n                       (--metrics FILE) (--compact) (--gzip) (--packed)"
+          + "\n                       (--tokenizer nltk|regex)"
+          + "\n    $ python3 build.py (-h | --help)\n")
+
+
+if __name__ == '__main__':
+
+    options = dict(getopt.getopt(sys.argv[1:], 'm:r:i:d:e:h',
+                                 ['keep=', 'workers=', 'crash', 'metrics=', 'compact',
+                                  'gzip', 'packed', 'tokenizer=', 'help'])[0])
+    if '-h' in options or '--help' in options or '-m' not in options:
+        usage()
+    else:
+        keep = [s for s in options.get('--keep', '').split(',') if s]
+        for stage in keep:
+            if stage not in STAGES:
+                exit("Unknown stage to keep: %s" % stage)
+        Progress.metrics_file = options.get('--metrics')
+        set_output_options(options)
+        generate_topics.TOKENIZER = options.get('--tokenizer', generate_topics.TOKENIZER)
+        end = int(options['-e']) if '-e' in options else None
+        build(options['-m'], options['-r'], options['-i'], options['-d'], end=end,
+              keep=keep, crash='--crash' in options, workers=int(options.get('--workers', 1)))
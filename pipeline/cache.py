@@ -0,0 +1,77 @@
+"""cache.py
+
+On-disk cache for objects that are expensive to build from a source file, like
+the parsed COVID metadata and the Harvard processing results.
+
+>>> metadata = cached('metadata', metadata_file, lambda: Metadata(metadata_file), version=2)
+
+The first call builds the object and pickles it into CACHE_DIR, later calls
+unpickle it. Cache files are keyed on a hash of the contents of the source
+file, so a changed source file is never served from the cache, and on a version
+of the layout of the cached object, which callers should increase whenever the
+attributes of the object change so that old cache files are not loaded. To avoid hashing
+large source files on every run, the hash is remembered together with the size
+and modification time of the file and only recomputed when those change.
+
+"""
+
+import os
+import json
+import pickle
+import hashlib
+
+
+CACHE_DIR = 'data/cache'
+HASHES_FILE = 'hashes.json'
+
+# set to False to always build objects from their source files
+ENABLED = True
+
+
+def cached(kind, source_file, build, version=1):
+    """Return the object of the given kind for source_file, either from the cache
+    or by calling build(), which should create the object from source_file. The
+    kind and the version of the object layout are used in the cache file name,
+    the kind should be different for different kinds of objects created from
+    the same source file."""
+    if not ENABLED:
+        return build()
+    cache_file = os.path.join(
+        CACHE_DIR, "%s-v%d-%s.pkl" % (kind, version, content_hash(source_file)))
+    if os.path.exists(cache_file):
+        print("Loading %s from %s" % (kind, cache_file))
+        with open(cache_file, 'rb') as fh:
+            return pickle.load(fh)
+    obj = build()
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(tmp_file, 'wb') as fh:
+        pickle.dump(obj, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return obj
+
+
+def content_hash(fname):
+    """Return a hash of the contents of fname. The hash is only computed if the
+    size or modification time of the file changed since it was last computed."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    hashes_file = os.path.join(CACHE_DIR, HASHES_FILE)
+    hashes = {}
+    if os.path.exists(hashes_file):
+        with open(hashes_file) as fh:
+            hashes = json.load(fh)
+    path = os.path.abspath(fname)
+    stat = os.stat(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    entry = hashes.get(path)
+    if entry is not None and entry['signature'] == signature:
+        return entry['hash']
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(chunk)
+    hashes[path] = {'signature': signature, 'hash': digest.hexdigest()}
+    tmp_file = "%s.%d.tmp" % (hashes_file, os.getpid())
+    with open(tmp_file, 'w') as fh:
+        json.dump(hashes, fh, indent=4)
+    os.replace(tmp_file, hashes_file)
+    return hashes[path]['hash']
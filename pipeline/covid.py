@@ -13,6 +13,16 @@ in this case it was all_sources_metadata_2020-03-13.csv. LIF files are written
 to OUT_DIR. The optional last argument can be used to restrict processing to
 some number of files, default is to process all of them.
 
+With --workers N the files are converted by a pool of N processes. The metadata
+is loaded once and only a compact table from shas to PMIDs and years is handed
+to the workers. The run ends with a summary of converted, skipped (incomplete)
+and failed files.
+
+The inputs of each converted file, which are the file and its PMID and year from
+the metadata, are recorded in a manifest next to OUT_DIR (see manifest.py).
+With --incremental, files are skipped if their output exists and their inputs
+did not change, this also makes it possible to resume an interrupted run.
+
 
 == Creating a relations file
 
@@ -31,10 +41,50 @@ $ python3 covid.py --import METADATA_FILE PROCESSING_RESULTS LIF_DIR HAR_DIR N?
 For each file in LIF_DIR a file will be created in HAR_DIR which has the reified
 relations from the Harvard data as metadata (because there were no offsets).
 
+Fingerprints of the relations of each document are saved in HAR_DIR. With
+--incremental only files whose relations changed since the last run are
+written. With --skip-empty no files are written for documents without relations,
+create_index.py treats a missing file as a document without relations. With
+--workers N the files are written by a pool of N processes.
+
+
+== Creating relation class files
+
+$ python3 covid.py --classes METADATA_FILE PROCESSING_RESULTS OUT_DIR
+
+Writes class-activators.txt, class-decreasers.txt, class-increasers.txt and
+class-inhibitors.txt to OUT_DIR, each with a list of the objects of one relation
+type and their subjects. Objects occurring less than 25 times are left out, use
+--threshold N to change that. Use --formats txt,json,tsv to also write the
+classes as JSON or as tab-separated values.
+
 TODO: this functionality as well as the --create-relations, should probably be
 done in another script.
 
 
+== Progress metrics
+
+All commands take an optional --metrics FILE argument, which makes progress
+reporters append metrics to FILE as JSON lines.
+
+
+== Output format
+
+LIF files are pretty-printed by default. The --compact option writes them
+without indentation and the --gzip option compresses them and adds .gz to the
+file names. Input files may be compressed or not. With --packed, output
+directories that do not exist yet are created as packed stores (see store.py),
+input directories can be packed stores or regular directories.
+
+
+== Caching
+
+The parsed metadata and Harvard processing results are cached in data/cache
+(see cache.py), so only the first run on a metadata or results file pays for
+parsing it. The cache is keyed on the contents of the file and a changed file
+is parsed again. Use --no-cache to bypass the cache.
+
+
 == Example
 
 export COVID=/Users/Shared/DATA/resources/corpora/covid-19
@@ -44,8 +94,11 @@ export DATA=$COVID/2020-03-13/comm_use_subset
 export OUT=$COVID/processed
 
 python3 covid.py --convert $META $DATA $OUT/lif 5
+python3 covid.py --convert $META $DATA $OUT/lif --workers 8
 python3 covid.py --create-relations $META $HARVARD $OUT/containers.json
+python3 covid.py --classes $META $HARVARD data --formats txt,tsv
 python3 covid.py --import $META $HARVARD $OUT/lif $OUT/har 10
+python3 covid.py --import $META $HARVARD $OUT/lif $OUT/har --incremental --skip-empty --workers 8
 
 """
 
@@ -55,45 +108,193 @@ import sys
 import csv
 import json
 import random
+import hashlib
 import textwrap
+from array import array
+from multiprocessing import Pool
 
 from io import StringIO
 from collections import Counter
 
 from lif import LIF, View, Text, Annotation
+from utils import Progress, open_file, set_output_options, batches, print_errors
+from utils import get_settings, apply_settings
+from store import open_store, document_key
+from manifest import Manifest
+from relations import RELTYPES, RelationTable
+import cache
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+BATCH_SIZE = 100
+
+# relation types with agent and patient names, used for the class files
+RELATION_CLASSES = [('Inhibition', 'inhibitor', 'inhibitee'),
+                    ('Activation', 'activator', 'activatee'),
+                    ('IncreaseAmount', 'increaser', 'increasee'),
+                    ('DecreaseAmount', 'decreaser', 'decreasee')]
+
+# minimum number of occurrences of an object in the class files
+CLASS_THRESHOLD = 25
 
+# file in the har directory with fingerprints of the relations of each document
+FINGERPRINTS_FILE = 'fingerprints.json'
 
-# TODO: add the others
-RELTYPES = {'Activation': ('activates', 'activator'),
-            'Inhibition': ('inhibits','inhibitor'),
-            'IncreaseAmount': ('increases', 'increaser'),
-            'DecreaseAmount': ('decreases', 'decreaser')}
+# number of relations collected in streaming mode before they are added to the
+# relation table
+RELATION_BUFFER_SIZE = 10000
 
+# version of the Metadata and HarvardResults attributes stored in the cache,
+# change this when those attributes change
+CACHE_VERSION = 2
 
-def convert_into_lif(metadata_file, data_dir, out_dir, n=99999):
+
+def convert_into_lif(metadata_file, data_dir, out_dir, n=99999, workers=1):
     """Load Covid metadata and convert Covid JSON files fron data_dir into LIF files
-    and save them in out_dir."""
+    and save them in out_dir, using a pool of processes if workers > 1."""
     print('Loading metadata...')
-    metadata = Metadata(metadata_file)
-    for fname in os.listdir(data_dir)[:n]:
-        infile = os.path.join(data_dir, fname)
-        outfile = os.path.join(out_dir, fname)
-        Converter(infile, outfile, metadata).convert()
+    lookup = MetadataLookup(load_metadata(metadata_file, lean=True))
+    fnames = os.listdir(data_dir)[:n]
+    progress = Progress('convert', total=len(fnames))
+    converted = skipped = unchanged = 0
+    errors = []
+    jobs = [(data_dir, batch) for batch in batches(fnames, BATCH_SIZE)]
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_converter,
+                    initargs=(lookup, out_dir, get_settings()))
+        results = pool.imap_unordered(_convert_batch, jobs)
+    else:
+        pool = None
+        _init_converter(lookup, out_dir)
+        results = map(_convert_batch, jobs)
+    for batch_converted, batch_skipped, batch_unchanged, size, batch_errors in results:
+        converted += batch_converted
+        skipped += batch_skipped
+        unchanged += batch_unchanged
+        errors.extend(batch_errors)
+        progress.add(docs=batch_converted + batch_skipped + batch_unchanged, bytes=size,
+                     errors=len(batch_errors))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        _CONVERTER['store'].close()
+        _CONVERTER['manifest'].close()
+    Manifest(out_dir).compact()
+    metrics = progress.finish(converted=converted, skipped=skipped, unchanged=unchanged,
+                              failed=len(errors))
+    print("\nConverted %d files, skipped %d incomplete files and %d unchanged files, "
+          "%d files failed (%.1f files/sec)"
+          % (converted, skipped, unchanged, len(errors), metrics['docs_per_sec']))
+    print_errors(errors)
+
+
+# metadata lookup, output store and manifest used by _convert_batch(), set once
+# for each worker process by _init_converter()
+_CONVERTER = {}
+
+
+def _init_converter(lookup, out_dir, settings=None):
+    if settings is not None:
+        apply_settings(settings)
+    _CONVERTER['metadata'] = lookup
+    _CONVERTER['store'] = open_store(out_dir, 'lif')
+    _CONVERTER['manifest'] = Manifest(out_dir)
+
+
+def _convert_batch(job):
+    """Convert a batch of files. Returns the number of converted files, the number
+    of skipped files, the number of unchanged files, the number of characters
+    written and a list of (fname, error) pairs. Files are unchanged if their
+    output exists and neither the file nor its metadata changed since the output
+    was written, these are only skipped with the --incremental option."""
+    data_dir, fnames = job
+    lookup = _CONVERTER['metadata']
+    store = _CONVERTER['store']
+    manifest = _CONVERTER['manifest']
+    converted = skipped = unchanged = size = 0
+    errors = []
+    for fname in fnames:
+        try:
+            infile = os.path.join(data_dir, fname)
+            key = document_key(fname)
+            # the signature is only needed to check for unchanged files and to
+            # record files that were converted
+            signature = None
+            if Manifest.skip_unchanged:
+                signature = _input_signature(infile, key, lookup)
+                if manifest.is_current(key, signature) and key in store:
+                    unchanged += 1
+                    continue
+            chars = Converter(infile, store, lookup).convert()
+            if chars and signature is None:
+                signature = _input_signature(infile, key, lookup)
+        except Exception as e:
+            errors.append((fname, "%s: %s" % (type(e).__name__, e)))
+            continue
+        if chars:
+            converted += 1
+            size += chars
+            manifest.record(key, signature)
+        else:
+            skipped += 1
+    return converted, skipped, unchanged, size, errors
+
+
+def _input_signature(infile, key, lookup):
+    """Return the manifest signature for a file and its metadata."""
+    with open_file(infile, 'rb') as fh:
+        return Manifest.signature(
+            fh.read(), str(lookup.get_pmid(key)), str(lookup.get_year(key)))
 
 
 def create_relations_file(metadata_file, results_file, out_file):
     """Create a file with reified relations and write it to out_file. This requires
     the COVID metadata and the Harvard processing results."""
     print('Loading metadata...')
-    metadata = Metadata(metadata_file)
+    metadata = load_metadata(metadata_file, lean=True)
     print('Loading Harvard processing results...')
-    results = HarvardResults(results_file)
-    rels = results.collect_relations(metadata)
-    idx = index_by_fname(rels)
-    reified_rels = reify_relations(rels)
+    results = load_harvard_results(results_file, metadata)
+    reified_rels = results.relation_table(metadata).reified_relations()
     for rt in reified_rels:
         print(rt, len(reified_rels[rt]))
-    json.dump(reified_rels, open(out_file, 'w'), indent=True)
+    with open(out_file, 'w') as fh:
+        json.dump(reified_rels, fh, indent=True)
+
+
+def load_metadata(csv_file, lean=False):
+    """Return the Metadata for csv_file, taking it from the cache if possible."""
+    kind = 'metadata-lean' if lean else 'metadata'
+    state = cache.cached(kind, csv_file, lambda: Metadata(csv_file, lean=lean).__dict__,
+                         version=CACHE_VERSION)
+    metadata = _from_state(Metadata, state)
+    # the cached state has the path the metadata were first read from
+    metadata.csv_file = csv_file
+    return metadata
+
+
+def load_harvard_results(json_file, metadata=None):
+    """Return the HarvardResults for json_file, taking them from the cache if
+    possible. The results are read in streaming mode if metadata are given."""
+    kind = 'harvard'
+    if metadata is not None and cache.ENABLED:
+        # relations collected in streaming mode depend on the metadata
+        kind = 'harvard-streamed-%s' % cache.content_hash(metadata.csv_file)
+    build = lambda: HarvardResults(json_file, metadata).__dict__
+    state = cache.cached(kind, json_file, build, version=CACHE_VERSION)
+    return _from_state(HarvardResults, state)
+
+
+def _from_state(cls, state):
+    # the cache stores instance dictionaries rather than instances so that cache
+    # files do not depend on whether this module runs as __main__ or not
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    return obj
 
 
 def translate_reltype_into_action(reltype):
@@ -106,7 +307,12 @@ def translate_reltype_into_role(reltype):
 class Metadata(object):
 
     """Reads the CSV file with the COVID metadata and stores each line as a list of
-    fields in the data instance variable."""
+    fields in the data instance variable.
+
+    In lean mode the lines are not stored. Instead, shas are mapped to an index
+    into a column of interned PMIDs and a column of years stored as an array of
+    unsigned shorts (with 0 for a missing year), and the identifier counts are
+    computed while reading the file."""
 
     # Some counts (first column for 3/13 download, second for 3/20 download):
     #
@@ -114,43 +320,82 @@ class Metadata(object):
     # pmcid      27,338  23,320
     # pubmed_id  16,731  22,944
 
-    def __init__(self, csv_file):
-        self.fh = open(csv_file)
-        self.reader = csv.reader(self.fh)
+    def __init__(self, csv_file, lean=False):
+        self.csv_file = csv_file
+        self.lean = lean
         self.data = []
-        for fields in self.reader:
-            self.data.append(fields)
         self.sha2pmid = {}
         self.sha2year = {}
         self.pmid2sha = {}
-        lines = 0
+        # only used in lean mode
+        self.sha2idx = {}
+        self.pmids = []
+        self.years = array('H')
+        self.identifier_counts = [0, 0, 0]
+        self.lines = 0
         year_errors = 0
-        for fields in self.data:
-            lines += 1
-            sha = fields[0]
-            pmcid = fields[4]
-            pmid = fields[5]
-            year = fields[8].lstrip("['")
-            if len(year) > 4 and year[4] in ' -' and year[:4].isdigit():
-                year = year[:4]
-            self.sha2pmid[sha] = pmid
-            try:
-                self.sha2year[sha] = int(year)
-            except ValueError:
-                year_errors += 1
-            self.pmid2sha[pmid] = sha
-        print("Read %s lines and found %s missing years" % (lines, year_errors))
+        with open(csv_file) as fh:
+            for fields in csv.reader(fh):
+                self.lines += 1
+                if not lean:
+                    self.data.append(fields)
+                for i in (0, 1, 2):
+                    if fields[3 + i]:
+                        self.identifier_counts[i] += 1
+                sha = sys.intern(fields[0])
+                pmid = sys.intern(fields[5])
+                year = fields[8].lstrip("['")
+                if len(year) > 4 and year[4] in ' -' and year[:4].isdigit():
+                    year = year[:4]
+                try:
+                    year = int(year)
+                except ValueError:
+                    year = None
+                    year_errors += 1
+                if lean:
+                    self._add_lean(sha, pmid, year)
+                else:
+                    self.sha2pmid[sha] = pmid
+                    if year is not None:
+                        self.sha2year[sha] = year
+                self.pmid2sha[pmid] = sha
+        print("Read %s lines and found %s missing years" % (self.lines, year_errors))
+
+    def _add_lean(self, sha, pmid, year):
+        if year is not None and not 0 < year < 65536:
+            # does not fit the array and is not a real year anyway
+            year = None
+        idx = self.sha2idx.get(sha)
+        if idx is None:
+            self.sha2idx[sha] = len(self.pmids)
+            self.pmids.append(pmid)
+            self.years.append(0 if year is None else year)
+        else:
+            self.pmids[idx] = pmid
+            if year is not None:
+                self.years[idx] = year
 
     def __getitem__(self, i):
+        if self.lean:
+            raise TypeError("lines are not kept by Metadata in lean mode")
         return self.data[i]
     
     def __len__(self):
-        return len(self.data)
+        return self.lines
+
+    def get_shas(self):
+        return self.sha2idx.keys() if self.lean else self.sha2pmid.keys()
 
     def get_pmid(self, sha):
+        if self.lean:
+            idx = self.sha2idx.get(sha)
+            return None if idx is None else self.pmids[idx]
         return self.sha2pmid.get(sha)
 
     def get_year(self, sha):
+        if self.lean:
+            idx = self.sha2idx.get(sha)
+            return None if idx is None or self.years[idx] == 0 else self.years[idx]
         return self.sha2year.get(sha)
 
     def get_sha(self, pmid):
@@ -158,16 +403,26 @@ class Metadata(object):
 
     def count_identifiers(self):
         """Return counts for doi, pmcid and pubmed_id identifiers."""
-        doi = 0
-        pmcid = 0
-        pubmed_id = 0
-        for l in self.data:
-            if l[3]: doi += 1
-            if l[4]: pmcid += 1
-            if l[5]: pubmed_id += 1
+        doi, pmcid, pubmed_id = self.identifier_counts
         print(doi, pmcid, pubmed_id)
 
 
+class MetadataLookup(object):
+
+    """Read-only table from shas to PMIDs and years, this has just what Converter
+    needs from Metadata and is small enough to be handed to worker processes."""
+
+    def __init__(self, metadata):
+        self.table = {sha: (metadata.get_pmid(sha), metadata.get_year(sha))
+                      for sha in metadata.get_shas()}
+
+    def get_pmid(self, sha):
+        return self.table.get(sha, (None, None))[0]
+
+    def get_year(self, sha):
+        return self.table.get(sha, (None, None))[1]
+
+
 class CovidData(object):
 
     """Class whose only goal is to create files named class-activators.txt,
@@ -187,30 +442,55 @@ class CovidData(object):
                 rels.append((relation_type, sample['subj']['name'], sample['obj']['name']))
         return rels
 
-    def write_relation_classes(self):
+    def relation_classes(self):
+        """Return the classes of inhibitors, activators, increasers and decreasers
+        as a dictionary keyed on the agent name (for example 'inhibitor'). Each
+        class is a list of (object, count, subjects) triples, ordered on count,
+        where subjects is a list of (subject, count) pairs, also ordered on count.
+        All classes are collected in one scan over the statements."""
+        classes = {rel: {} for rel, agent, patient in RELATION_CLASSES}
+        for rel, subjects in classes.items():
+            for sample in self.results.types.get(rel, []):
+                if 'subj' in sample and 'obj' in sample:
+                    obj = sample['obj']['name']
+                    subjects.setdefault(obj, Counter())[sample['subj']['name']] += 1
+        result = {}
+        for rel, agent, patient in RELATION_CLASSES:
+            subjects = classes[rel]
+            counter = Counter({obj: sum(c.values()) for obj, c in subjects.items()})
+            result[agent] = [(obj, count, subjects[obj].most_common())
+                             for obj, count in counter.most_common()]
+        return result
+
+    def write_relation_classes(self, out_dir='.', threshold=CLASS_THRESHOLD, formats=('txt',)):
         """Write classes of inhibitors, activators, increasers and decreasers to a
-        couple of files in the working directory."""
-        classes = [('Inhibition', 'inhibitor', 'inhibitee'),
-                   ('Activation', 'activator', 'activatee'),
-                   ('IncreaseAmount', 'increaser', 'increasee'),
-                   ('DecreaseAmount', 'decreaser', 'decreasee')]
-        for rel, agent, patient in classes:
-            fh = open('class-%ss.txt' % agent, 'w')
-            rels = self.collect_relations(rel)
-            counter = Counter([r[2] for r in rels])
-            args = {}
-            for rel in rels:
-                args.setdefault(rel[2], []).append(rel[1])
-            for key in args.keys():
-                args[key] = Counter(args[key])
-            for ent, count in counter.most_common():
-                if count >= 25:
-                    fh.write("%s %s %ss\n" % (count, ent, agent))
-                    for ent2, count2 in args[ent].most_common():
-                        if count2 > 0:
-                            fh.write('  %s %s\n' % (count2, ent2))
-                    fh.write('\n')
-            fh.close()
+        couple of files in out_dir, with names like class-inhibitors.txt. Only
+        objects that occur at least threshold times are included. Besides the
+        text format the classes can be written as JSON and as tab-separated
+        values, with one line for each object-subject pair."""
+        for fmt in formats:
+            if fmt not in ('txt', 'json', 'tsv'):
+                raise ValueError("unknown output format: %s" % fmt)
+        os.makedirs(out_dir, exist_ok=True)
+        for agent, objects in self.relation_classes().items():
+            objects = [o for o in objects if o[1] >= threshold]
+            for fmt in formats:
+                fname = os.path.join(out_dir, 'class-%ss.%s' % (agent, fmt))
+                with open(fname, 'w') as fh:
+                    if fmt == 'txt':
+                        for obj, count, subjects in objects:
+                            fh.write("%s %s %ss\n" % (count, obj, agent))
+                            for subj, subj_count in subjects:
+                                fh.write('  %s %s\n' % (subj_count, subj))
+                            fh.write('\n')
+                    elif fmt == 'json':
+                        json.dump([{'object': obj, 'count': count, 'subjects': subjects}
+                                   for obj, count, subjects in objects], fh, indent=2)
+                    elif fmt == 'tsv':
+                        fh.write("object\tcount\tsubject\tsubject_count\n")
+                        for obj, count, subjects in objects:
+                            for subj, subj_count in subjects:
+                                fh.write("%s\t%s\t%s\t%s\n" % (obj, count, subj, subj_count))
 
 
 class CovidDoc(object):
@@ -222,7 +502,8 @@ class CovidDoc(object):
         the COVID meta data."""
         # TODO: process authors at this spot, like with the sections
         # TODO: process the body text a bit further too (no duplicate headers)
-        self.json = json.load(open(fname))
+        with open_file(fname) as fh:
+            self.json = json.load(fh)
         self.id = self.json['paper_id']
         self.pmid = covid_data.get_pmid(self.id)
         self.year = covid_data.get_year(self.id)
@@ -262,6 +543,17 @@ class Identifiers(object):
 
 class HarvardResults(object):
 
+    """Reads the Harvard processing results, a JSON file with a list of statements,
+    and indexes the statements on their type.
+
+    When metadata are handed in the results are read in streaming mode, where
+    statements are parsed one at a time (using ijson if it is installed) and
+    not kept. The type index, the characterization and the relations of the four
+    types in RELTYPES are all collected in one pass over the statements. In this
+    mode the type index only has the statements for those four types and only
+    with their type, subject name and object name, which is what CovidData needs,
+    and the relations are stored in a RelationTable."""
+
     # We are not using the database references, but for future reference it uses
     # the following:
     #
@@ -269,25 +561,68 @@ class HarvardResults(object):
     #   UP for Uniprot
     #   FPLX for the FamPlex namespace
     
-    def __init__(self, json_file):
+    def __init__(self, json_file, metadata=None):
         self.fname = json_file
-        self.results = json.load(open(self.fname))
+        self.streaming = metadata is not None
+        self.results = []
         self.types = {}
+        self.type_counts = Counter()
         self.characterizations = {}
-        for result in self.results:
-            self.types.setdefault(result['type'], []).append(result)
-        self._init_characterization()
+        # only used in streaming mode, rows are numbered on the position of the
+        # statement they were taken from
+        self.table = RelationTable()
+        relations = []
+        positions = []
+        key_counts = {}
+        for position, result in enumerate(self._read_results()):
+            reltype = result['type']
+            self.type_counts[reltype] += 1
+            key_counts.setdefault(reltype, Counter()).update(result.keys())
+            if not self.streaming:
+                self.results.append(result)
+                self.types.setdefault(reltype, []).append(result)
+            elif reltype in RELTYPES:
+                args = relation_arguments(result)
+                if args is None:
+                    continue
+                self.types.setdefault(reltype, []).append(
+                    {'type': reltype, 'subj': {'name': args[0]}, 'obj': {'name': args[1]}})
+                relation = make_relation(result, args, metadata)
+                if relation is not None:
+                    relations.append(relation)
+                    positions.append(position)
+                    if len(relations) >= RELATION_BUFFER_SIZE:
+                        self.table.extend(relations, positions)
+                        relations, positions = [], []
+        self.table.extend(relations, positions)
+        self._init_characterization(key_counts)
+
+    def _read_results(self):
+        with open(self.fname, 'rb') as fh:
+            if self.streaming and ijson is not None:
+                yield from ijson.items(fh, 'item', use_float=True)
+            else:
+                results = json.load(fh)
+                if not self.streaming:
+                    yield from results
+                else:
+                    # hand out the statements from the end of the list so they
+                    # can be freed as we go
+                    results.reverse()
+                    while results:
+                        yield results.pop()
 
     def __getitem__(self, i):
+        if self.streaming:
+            raise TypeError("results are not kept by HarvardResults in streaming mode")
         return self.results[i]
 
     def __len__(self):
-        return len(self.results)
+        return sum(self.type_counts.values())
 
     def print_types(self):
         """Show the list of relation types."""
-        c = Counter([result['type'] for result in self.results])
-        return c.most_common()
+        return self.type_counts.most_common()
     
     def get_sample(self, result_type):
         """Return a single random sample result for a particular relation type."""
@@ -298,14 +633,11 @@ class HarvardResults(object):
         pool = self.types.get(result_type, [])
         return random.choices(pool, k=n)
 
-    def _init_characterization(self):
+    def _init_characterization(self, key_counts):
         """Show what kind of arguments we have for each relation type."""
-        for t in sorted(self.types.keys()):
-            count = len(self.types[t])
-            keys = []
-            for r in self.types[t]:
-                keys.extend(r.keys())
-            c = Counter(keys)
+        for t in sorted(key_counts.keys()):
+            count = self.type_counts[t]
+            c = key_counts[t]
             for k in ('type', 'matches_hash', 'id', 'belief'):
                 if c[k] == count:
                     del(c[k])
@@ -315,32 +647,30 @@ class HarvardResults(object):
         """Collect all relations and return them as a list of four-tuples with relation
         type, subject, object and an evidence list. This method requires access
         to an instace of CovidData. Four relation types are collected:
-        Activation, Inhibition, IncreaseAmount and DecreaseAmount."""
-        target_relations = ('Activation', 'Inhibition',
-                            'IncreaseAmount', 'DecreaseAmount')
+        Activation, Inhibition, IncreaseAmount and DecreaseAmount. Only the
+        first n statements are used. In streaming mode the relations were
+        already collected, using the metadata that were handed in then."""
+        if self.streaming:
+            return self.table.relations(n)
         relations = []
         for result in self.results[:n]:
-            reltype = result['type']
-            if reltype not in target_relations:
+            if result['type'] not in RELTYPES:
                 continue
-            try:
-                sub = result['subj']['name']
-                obj = result['obj']['name']
-            except KeyError:
-                # we want both a subject and an object
+            args = relation_arguments(result)
+            if args is None:
                 continue
-            evidence = []
-            for e in result['evidence']:
-                pmid = e.get('pmid')
-                text = e.get('text')
-                sha = metadata.get_sha(pmid)
-                if sha is not None:
-                    evidence.append((pmid, sha, text))
+            relation = make_relation(result, args, metadata)
             # don't keep relations that come without evidence
-            if evidence:
-                relations.append((reltype, sub, obj, evidence))
+            if relation is not None:
+                relations.append(relation)
         return relations
 
+    def relation_table(self, metadata, n=100000):
+        """Return a RelationTable with the relations from collect_relations()."""
+        if self.streaming and (not self.table or self.table.statement[-1] < n):
+            return self.table
+        return RelationTable(self.collect_relations(metadata, n))
+
     def print_characterization(self):
         for relation_type in self.characterizations.keys():
             type_characterization = self.characterizations[relation_type]
@@ -358,7 +688,7 @@ class HarvardResults(object):
                 self._print_arg('subj', sample['subj'])
             if 'obj' in sample:
                 self._print_arg('obj ', sample['obj'])
-            for e in sample['evidence']:
+            for e in sample.get('evidence', []):
                 pmid = e['pmid']
                 sha = covid.pmid2sha.get(pmid)
                 print('\n   ', pmid, sha)
@@ -375,6 +705,31 @@ class HarvardResults(object):
             print()
 
 
+def relation_arguments(result):
+    """Return the subject and object names of a statement, or None if it does not
+    have both."""
+    try:
+        return result['subj']['name'], result['obj']['name']
+    except KeyError:
+        return None
+
+
+def make_relation(result, args, metadata):
+    """Return the relation for a statement as a four-tuple with relation type,
+    subject, object and evidence, where the evidence is a list of (pmid, sha,
+    text) triples for documents in the metadata. Returns None if there is no
+    such evidence."""
+    evidence = []
+    for e in result['evidence']:
+        pmid = e.get('pmid')
+        sha = metadata.get_sha(pmid)
+        if sha is not None:
+            evidence.append((pmid, sha, e.get('text')))
+    if not evidence:
+        return None
+    return (result['type'], args[0], args[1], evidence)
+
+
 def index_by_fname(relations):
     """Take a list of relations as created by HarvardResults.collect_relations() and
     return the relations indexed on the filename."""
@@ -408,13 +763,7 @@ def reify_relations(relations):
        }]
 
     """
-    rels = { reltype: {} for reltype in RELTYPES }
-    for rel in relations:
-        reified_rel = "%s-%s" % (rel[2], translate_reltype_into_role(rel[0]))
-        rels[rel[0]].setdefault(reified_rel, {})
-        ds = [{'pmid': e[0], 'sha': e[1], 'text': e[2]} for e in rel[3]]
-        rels[rel[0]][reified_rel].setdefault(rel[1], []).extend(ds)
-    return rels
+    return RelationTable(relations).reified_relations()
 
 
 def print_relations(relations):
@@ -445,22 +794,33 @@ class Converter(object):
     # TODO: add the directory of the sourcefile to the metadata
     # TODO: (this is to destinguish between the licenses)
 
-    def __init__(self, infile, outfile, metadata):
+    def __init__(self, infile, store, metadata):
+        """Read infile, the store is where convert() writes the LIF object and can
+        be None if only create_lif() is used."""
         self.infile = infile
-        self.outfile = outfile
+        self.store = store
+        self.key = os.path.basename(infile).split('.')[0]
         self.doc = CovidDoc(self.infile, metadata)
 
     def convert(self):
-        print('Converting', os.path.basename(self.infile))
+        """Convert the document and return the number of characters written, which
+        is zero if the document was skipped because it was not complete."""
+        lif = self.create_lif()
+        if lif is None:
+            return 0
+        return self.store.write(self.key, lif.as_json(), newline=True)
+
+    def create_lif(self):
+        """Return the LIF object for the document, or None if the document was
+        skipped because it was not complete."""
         if not self.doc.is_complete():
-            print('skipping')
-            return
-        with open(self.outfile, 'w') as fh:
-            self._setup()
-            self._collect_metadata()
-            self._add_abstract()
-            self._add_sections()
-            self._finish()
+            return None
+        self._setup()
+        self._collect_metadata()
+        self._add_abstract()
+        self._add_sections()
+        self._finish()
+        return self.lif
 
     def _setup(self):
         Identifiers.reset()
@@ -519,71 +879,103 @@ class Converter(object):
             section_p0 = self.p
 
     def _finish(self):
-        """Gather it all up and write output."""
+        """Gather it all up."""
         self.lif.text = Text(json_obj={'language': 'en', '@value': self.text.getvalue()})
         self.lif.views.append(self.view)
-        self.lif.write(self.outfile, pretty=True)
 
 
 class RelationImporter():
 
     def __init__(self, metadata_file, results_file, lif_dir, out_dir, n=99999):
         print('Loading metadata...')
-        self.metadata = Metadata(metadata_file)
+        self.metadata = load_metadata(metadata_file, lean=True)
         print('Loading Harvard processing results...')
-        self.results = HarvardResults(results_file)
+        self.results = load_harvard_results(results_file, self.metadata)
         self.lif_dir = lif_dir
         self.out_dir = out_dir
 
-    def convert(self, n=100000):
+    def convert(self, n=100000, workers=1, incremental=False, skip_empty=False):
+        """Write the relations for the first n files in the LIF directory, using a
+        pool of processes if workers > 1. In incremental mode files are only
+        written if their relations changed since the last run, which is checked
+        with the fingerprints saved in the output directory. With skip_empty no
+        files are written for documents without relations, unless an older file
+        with relations has to be overwritten."""
         print('Converting files...')
-        self.relations = self.results.collect_relations(self.metadata)
-        self.reified_rels = reify_relations(self.relations)
-        self.filter_relobjs()
-        self.invert_filtered_relobjs()
+        self.prepare()
         #self.print_reified_rels_counts()
         #self.print_filtered_relobjs()
         #print(len(self.inverted_rels))
-        for fname in os.listdir(self.lif_dir)[:n]:
-            infile = os.path.join(self.lif_dir, fname)
-            outfile = os.path.join(self.out_dir, fname)
-            if outfile.endswith('.json'):
-                outfile = outfile[:-4] + 'lif'
-            self.convert_file(fname, infile, outfile)
-
-    def convert_file(self, fname, infile, outfile):
-        print(infile)
-        lif = LIF()
-        lif.text.value = None
-        lif.metadata['relations'] = {}
-        # PRINT
-        # print(self.relations[0])
-        for relobj, subj in self.inverted_rels.get(fname, []):
-            # PRINT
-            # print(subj, relobj)
-            lif.metadata['relations'].setdefault(relobj, []).append(subj)
-        lif.write(outfile, pretty=True)
+        keys = open_store(self.lif_dir, 'lif').keys()[:n]
+        out_store = open_store(self.out_dir, 'har')
+        fingerprints_file = os.path.join(self.out_dir, FINGERPRINTS_FILE)
+        fingerprints = read_fingerprints(fingerprints_file)
+        changed = []
+        unchanged = empty = 0
+        for key in keys:
+            relations = self.get_relations(key)
+            fingerprint = relations_fingerprint(relations)
+            previous = fingerprints.get(key)
+            fingerprints[key] = fingerprint
+            if key in out_store:
+                if incremental and fingerprint == previous:
+                    unchanged += 1
+                    continue
+            elif skip_empty and not relations:
+                empty += 1
+                continue
+            changed.append((key, relations))
+        out_store.close()
+        progress = Progress('import', total=len(keys))
+        progress.add(docs=unchanged + empty)
+        written = 0
+        errors = []
+        jobs = list(batches(changed, BATCH_SIZE))
+        if workers > 1:
+            pool = Pool(workers, initializer=_init_importer,
+                        initargs=(self.out_dir, get_settings()))
+            results = pool.imap_unordered(_import_batch, jobs)
+        else:
+            pool = None
+            _init_importer(self.out_dir)
+            results = map(_import_batch, jobs)
+        for docs, size, batch_errors in results:
+            written += docs
+            errors.extend(batch_errors)
+            progress.add(docs=docs + len(batch_errors), bytes=size, errors=len(batch_errors))
+        if pool is not None:
+            pool.close()
+            pool.join()
+        else:
+            _IMPORTER['store'].close()
+        # failed files should be written again on the next run
+        for key, error in errors:
+            del fingerprints[key]
+        write_fingerprints(fingerprints, fingerprints_file)
+        progress.finish(written=written, unchanged=unchanged, empty=empty, failed=len(errors))
+        print("\nWrote %d files, %d files unchanged, %d empty files skipped, %d files failed"
+              % (written, unchanged, empty, len(errors)))
+        print_errors(errors)
+
+    def prepare(self):
+        """Collect the relations and create the inverted_rels index."""
+        self.table = self.results.relation_table(self.metadata)
+        self.invert_filtered_relobjs()
+
+    def get_relations(self, key):
+        return document_relations(self.inverted_rels, key)
+
+    def convert_file(self, key, store):
+        return write_relations(store, key, self.get_relations(key))
 
     def filter_relobjs(self):
-        self.filtered_rels = { reltype: {} for reltype in RELTYPES }
-        for reltype in self.reified_rels:
-            for rel_obj in self.reified_rels[reltype]:
-                subjects = self.reified_rels[reltype][rel_obj]
-                #if not is_big(subjects.values(), reltype):
-                #    continue
-                self.filtered_rels[reltype].setdefault(rel_obj, {'size': size_of(subjects.values()), 'data': {}})
-                subjects_sorted = reversed(sorted([(len(v), k, v) for k, v in subjects.items()]))
-                for (i, subj, val) in list(subjects_sorted)[:8]:
-                    self.filtered_rels[reltype][rel_obj]['data'].setdefault(subj, []).extend(val)
+        """Create the filtered_rels index with for each reified relation its size
+        and the eight subjects with the most evidence."""
+        self.filtered_rels = self.table.filtered_relations()
 
     def invert_filtered_relobjs(self):
         """Create the inverted_rels index with the relations indexed on filenames."""
-        self.inverted_rels = {}
-        for reltype in self.reified_rels:
-            for relobj in self.filtered_rels[reltype]:
-                for subj in self.filtered_rels[reltype][relobj]['data']:
-                    for e in self.filtered_rels[reltype][relobj]['data'][subj]:
-                        self.inverted_rels.setdefault(e['sha'] + '.json', []).append((relobj, subj))
+        self.inverted_rels = self.table.inverted_relations()
 
     def print_significant_rel_objs(self):
         for reltype in self.filtered_rels:
@@ -606,8 +998,75 @@ class RelationImporter():
                 print()
 
     def print_reified_rels_counts(self):
-        for rt in self.reified_rels:
-            print(rt, len(self.reified_rels[rt]))
+        for rt, reified_rels in self.table.reified_relations().items():
+            print(rt, len(reified_rels))
+
+
+# output store used by _import_batch(), set once for each worker process by
+# _init_importer()
+_IMPORTER = {}
+
+
+def _init_importer(out_dir, settings=None):
+    if settings is not None:
+        apply_settings(settings)
+    _IMPORTER['store'] = open_store(out_dir, 'har')
+
+
+def _import_batch(batch):
+    """Write a batch of (key, relations) pairs. Returns the number of files
+    written, the number of characters written and a list of (key, error)
+    pairs."""
+    docs = size = 0
+    errors = []
+    for key, relations in batch:
+        try:
+            size += write_relations(_IMPORTER['store'], key, relations)
+            docs += 1
+        except Exception as e:
+            errors.append((key, "%s: %s" % (type(e).__name__, e)))
+    return docs, size, errors
+
+
+def document_relations(inverted_rels, key):
+    """Return the relations for a document from the inverted_rels index as a
+    dictionary keyed on reified relations with lists of subjects as values."""
+    relations = {}
+    for relobj, subj in inverted_rels.get(key + '.json', []):
+        relations.setdefault(relobj, []).append(subj)
+    return relations
+
+
+def relations_lif(relations):
+    """Return a LIF object with the relations of a document in the metadata."""
+    lif = LIF()
+    lif.text.value = None
+    lif.metadata['relations'] = relations
+    return lif
+
+
+def write_relations(store, key, relations):
+    """Write a LIF document with the relations of a document in the metadata and
+    return the number of characters written."""
+    return store.write(key, relations_lif(relations).as_json(), newline=True)
+
+
+def relations_fingerprint(relations):
+    return hashlib.blake2b(json.dumps(relations).encode('utf8'), digest_size=16).hexdigest()
+
+
+def read_fingerprints(fname):
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as fh:
+        return json.load(fh)
+
+
+def write_fingerprints(fingerprints, fname):
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    with open(fname + '.tmp', 'w') as fh:
+        json.dump(fingerprints, fh)
+    os.replace(fname + '.tmp', fname)
 
 
 def size_of(subj_sentences):
@@ -626,20 +1085,52 @@ def print_significant_relobjs():
         os.path.join(DATA, '2020-03-20', 'cord19_pmc_stmts_filt.json'),
         os.path.join(DATA, 'processed', 'lif'),
         os.path.join('/Users', 'marc', 'Downloads', 'out'))
-    rc.relations = rc.results.collect_relations(rc.metadata)
-    rc.reified_rels = reify_relations(rc.relations)
+    rc.table = rc.results.relation_table(rc.metadata)
     rc.filter_relobjs()
     rc.print_significant_rel_objs()
 
 
 if __name__ == '__main__':
 
+    if '--metrics' in sys.argv:
+        i = sys.argv.index('--metrics')
+        Progress.metrics_file = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+    if '--no-cache' in sys.argv:
+        sys.argv.remove('--no-cache')
+        cache.ENABLED = False
+    for flag in ('--compact', '--gzip', '--packed'):
+        if flag in sys.argv:
+            sys.argv.remove(flag)
+            set_output_options({flag: True})
+    incremental = '--incremental' in sys.argv
+    Manifest.skip_unchanged = incremental
+    skip_empty = '--skip-empty' in sys.argv
+    for flag in ('--incremental', '--skip-empty'):
+        if flag in sys.argv:
+            sys.argv.remove(flag)
+    workers = 1
+    if '--workers' in sys.argv:
+        i = sys.argv.index('--workers')
+        workers = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+    threshold = CLASS_THRESHOLD
+    if '--threshold' in sys.argv:
+        i = sys.argv.index('--threshold')
+        threshold = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+    formats = ['txt']
+    if '--formats' in sys.argv:
+        i = sys.argv.index('--formats')
+        formats = sys.argv[i + 1].split(',')
+        del sys.argv[i:i + 2]
+
     if sys.argv[1] == '--convert':
         metadata = sys.argv[2]
         data_dir = sys.argv[3]
         out_dir = sys.argv[4]
         n = int(sys.argv[5]) if len(sys.argv) > 5 else None
-        convert_into_lif(metadata, data_dir, out_dir, n)
+        convert_into_lif(metadata, data_dir, out_dir, n, workers=workers)
 
     elif sys.argv[1] == '--create-relations':
         metadata = sys.argv[2]
@@ -653,7 +1144,14 @@ if __name__ == '__main__':
         lif_dir = sys.argv[4]
         out_dir = sys.argv[5]
         n = int(sys.argv[6]) if len(sys.argv) > 6 else 100000
-        RelationImporter(metadata, results, lif_dir, out_dir).convert(n)
+        importer = RelationImporter(metadata, results, lif_dir, out_dir)
+        importer.convert(n, workers=workers, incremental=incremental, skip_empty=skip_empty)
+
+    elif sys.argv[1] == '--classes':
+        metadata = load_metadata(sys.argv[2], lean=True)
+        results = load_harvard_results(sys.argv[3], metadata)
+        out_dir = sys.argv[4]
+        CovidData(results).write_relation_classes(out_dir, threshold, formats)
 
     elif sys.argv[1] == '--test':
         print_significant_relobjs()
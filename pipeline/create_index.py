@@ -5,7 +5,9 @@ into ElasticSearch.
 
 Usage:
 
-$ python create_index_docs.py -d DATA_DIR -f FILELIST (-b BEGIN) (-e END) (--crash)
+$ python create_index_docs.py -d DATA_DIR -f FILELIST (-b BEGIN) (-e END) (--crash) (--metrics FILE)
+                              (--workers N) (--compact) (--gzip) (--packed) (--incremental)
+                              (--shard I/N) (--state FILE (--resume) (--checkpoint N))
 
 Directories:
 
@@ -14,7 +16,29 @@ top   topics
 har   relations from Harvard results
 ela   output
 
-Processes about 40 Covid documents per second.
+Processes about 40 Covid documents per second. With --workers N the filelist is
+split into batches that are handed out to a pool of N processes, the output is
+the same as for a serial run. Errors are collected and listed at the end of the
+run, use --crash to stop at the first error instead.
+
+With --shard I/N only lines I, I+N, I+2N and so on of the filelist are used, so N
+processes or machines can each take one shard. With --state FILE progress is
+checkpointed to FILE every 1000 lines (or every N with --checkpoint N) and the
+names of files that failed are written to FILE.retry, --resume continues from
+the last checkpoint (see runner.py).
+
+A missing har file is taken to mean that the document has no relations.
+
+The inputs of each document are recorded in DATA_DIR/ela.manifest (see
+manifest.py). With --incremental, documents are skipped if their output exists
+and their lif, top and har files did not change, which also makes it possible to
+resume an interrupted run.
+
+Input files in the lif, top and har directories may be gzipped, and each of
+those directories can also be a packed store (see store.py). Output is
+pretty-printed unless --compact is used, --gzip compresses the output and
+--packed writes the output to a packed store if the ela directory does not
+exist yet.
 
 
 == Example
@@ -27,63 +51,104 @@ python3 create_index.py -d $DATA -f data/filelist-comm_use-random.txt -e 5
 
 """
 
-import os, sys, json
+import sys
 from pprint import pformat
 from collections import Counter
 
-from lif import LIF, Annotation
-from utils import time_elapsed, elements, print_element, get_options
+from lif import LIF
+from utils import time_elapsed, get_options, print_errors, get_settings, apply_settings
+from runner import BatchRunner
+from store import get_store, close_stores, document_key
+from manifest import get_manifest, close_manifests
+
+
+BATCH_SIZE = 100
 
 
 @time_elapsed
-def create_documents(data_dir, filelist, start, end, crash=False):
+def create_documents(data_dir, filelist, start, end, crash=False, workers=1):
     print("$ python3 %s\n" % ' '.join(sys.argv))
-    ela_dir = os.path.join(data_dir, 'ela')
-    if not os.path.exists(ela_dir):
-        os.mkdir(ela_dir)
-    for n, fname in elements(filelist, start, end):
-        print_element(n, fname)
-        if crash:
-            create_document(data_dir, fname)
-        else:
-            try:
-                create_document(data_dir, fname)
-            except Exception as e:
-                print('ERROR:', Exception, e)
+    runner = BatchRunner(filelist, start, end)
+    errors = runner.run('create_index', _create_batch,
+                        lambda fnames: (data_dir, fnames, crash),
+                        workers=workers, batch_size=BATCH_SIZE,
+                        initializer=apply_settings, initargs=(get_settings(),))
+    close_stores()
+    close_manifests()
+    get_manifest(data_dir, 'ela').compact()
+    print_errors(errors)
+    return errors
+
+
+def _create_batch(job):
+    """Create the index documents for a batch of file names. Returns the number
+    of documents processed, the number of characters written and a list of
+    (fname, error) pairs. Runs in a worker process for parallel runs so it
+    takes a single argument and errors are returned as strings."""
+    data_dir, fnames, crash = job
+    docs = 0
+    size = 0
+    errors = []
+    for fname in fnames:
+        try:
+            size += create_document(data_dir, fname)
+            docs += 1
+        except Exception as e:
+            if crash:
+                raise
+            errors.append((fname, "%s: %s" % (type(e).__name__, e)))
+    return docs, size, errors
 
 
 def create_document(data_dir, fname):
-    # the subdir is really the document identifier
-    lif_file = os.path.join(data_dir, 'lif', fname)
-    top_file = os.path.join(data_dir, 'top', fname[:-4] + 'lif')
-    har_file = os.path.join(data_dir, 'har', fname[:-4] + 'lif')
-    if not os.path.exists(lif_file):
+    """Create the index document for fname and return the number of characters
+    written, which is zero if the LIF file does not exist or if the document
+    was skipped because its inputs did not change."""
+    # the file name without extension is really the document identifier
+    key = document_key(fname)
+    lif_store = get_store(data_dir, 'lif')
+    if key not in lif_store:
         print('Skipping...  %s' % fname)
-    else:
-        doc = Document(fname, data_dir, lif_file, top_file, har_file)
-        doc.write(os.path.join(data_dir, 'ela'))
+        return 0
+    lif_data = lif_store.read(key)
+    top_data = get_store(data_dir, 'top').read(key)
+    # the relation import may skip documents without relations
+    har_store = get_store(data_dir, 'har')
+    har_data = har_store.read(key) if key in har_store else None
+    ela_store = get_store(data_dir, 'ela')
+    manifest = get_manifest(data_dir, 'ela')
+    signature = manifest.signature(lif_data, top_data, har_data or b'')
+    if manifest.is_current(key, signature) and key in ela_store:
+        return 0
+    lif = LIF(json_string=lif_data, lean=True)
+    top = LIF(json_string=top_data, lean=True)
+    har = None if har_data is None else LIF(json_string=har_data, lean=True)
+    doc = Document(fname, data_dir, lif, top, har)
+    size = doc.write(ela_store)
+    manifest.record(key, signature)
+    return size
 
 
 def fix_view(identifier, view):
     annos = view.id['annotations']
     view.id = identifier
     view.annotations = []
-    for a in annos:
-        view.annotations.append(Annotation(a))
+    view.add_annotations_from_json(annos)
 
 
 class Document(object):
 
-    def __init__(self, fname, data_dir, lif_file, top_file, har_file):
+    def __init__(self, fname, data_dir, lif, top, har):
 
-        """Build a single LIF object with all relevant annotations. The annotations
+        """Build a single LIF object with all relevant annotations from the LIF
+        objects for the document, its topics and its relations. The annotations
         themselves are stored in the Annotations object in self.annotations."""
         self.id = fname
         self.fname = fname
         self.data_dir = data_dir
-        self.lif = LIF(json_file=lif_file)
-        self.top = LIF(json_file=top_file)
-        self.har = LIF(json_file=har_file)
+        self.lif = lif
+        self.top = top
+        self.har = har
         # NOTE: no idea why this was needed
         # TODO: there is an error in lif.py in line 80 where the json object is
         # handed in as the id
@@ -118,6 +183,8 @@ class Document(object):
         self.annotations.topic_elements = sorted(set(self.annotations.topic_elements))
 
     def _collect_relations(self):
+        if self.har is None:
+            return
         added = False
         for relobj, subjs in self.har.metadata['relations'].items():
             self.annotations.containers.append(relobj)
@@ -132,9 +199,9 @@ class Document(object):
         # if added:
         #    print(self.annotations.relations)
         
-    def write(self, dirname):
-        self.annotations.write(os.path.join(dirname, self.fname),
-                               self.lif.metadata["year"])
+    def write(self, store):
+        return self.annotations.write(store, document_key(self.fname),
+                                      self.lif.metadata["year"])
 
     def pp(self, prefix=''):
         views = ["%s:%d" % (view.id, len(view)) for view in self.lif.views]
@@ -196,8 +263,9 @@ class Annotations(object):
             self.relations[rel] = []
         self.text = None
 
-    def write(self, fname, year=None):
-        """Writes the document with the search fields to a json file."""
+    def write(self, store, key, year=None):
+        """Writes the document with the search fields to a store and returns the
+        number of characters written."""
         json_object = {
             "text": self.text,
             "docid": self.docid,
@@ -206,13 +274,12 @@ class Annotations(object):
             "author": self.authors,
             "topic": self.topics,
             "topic_element": self.topic_elements,
-            "containers": list(set(self.containers)),
-            "proteins": list(set(self.proteins)),
+            "containers": sorted(set(self.containers)),
+            "proteins": sorted(set(self.proteins)),
         }
         for relobj, subj in self.relations.items():
             json_object[relobj] = subj
-        with open(fname, 'w', encoding='utf8') as fh:
-            fh.write(json.dumps(json_object, sort_keys=True, indent=4))
+        return store.write(key, json_object)
 
     def pp(self, indent=''):
         print("%s%s\n" % (indent, self))
@@ -220,6 +287,6 @@ class Annotations(object):
 
 if __name__ == '__main__':
 
-    data_dir, filelist, start, end, crash = get_options()
-    create_documents(data_dir, filelist, start, end, crash=crash)
+    data_dir, filelist, start, end, crash, workers = get_options()
+    create_documents(data_dir, filelist, start, end, crash=crash, workers=workers)
 
@@ -2,22 +2,91 @@
 
 Module with some convenience code for acessing an Elastic Search index.
 
+All Index objects in a process share one client for each host and port, which
+keeps a pool of persistent connections that can be used from several threads at
+the same time. The size of the pool, the request timeout and the number of
+retries are taken from the CLIENT settings when the client is created.
+
+AsyncIndex is an asyncio version of Index for running many searches
+concurrently, it needs the aiohttp package:
+
+>>> idx = AsyncIndex('covid')
+>>> results = asyncio.run(idx.search_all(queries, concurrency=20))
+
 """
 
-from pprint import pprint
-from collections import Counter
+import os
 import json
+import time
+import asyncio
+import threading
+from pprint import pprint
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
 from elasticsearch.exceptions import NotFoundError
 
+try:
+    from elasticsearch import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
+
+from utils import Progress
+
+
+# Settings for the clients, maxsize is the number of connections kept open for
+# each host and timeout is in seconds. Requests that fail on connection errors
+# or timeouts are retried up to max_retries times on another connection.
+CLIENT = {'maxsize': 25, 'timeout': 30, 'max_retries': 3, 'retry_on_timeout': True}
+
+# clients created by get_client(), keyed on process, host and port
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(host='localhost', port=9200):
+    """Return the client for host and port, which is created when it is first
+    needed in this process and then shared by all its users. A process created
+    by a fork does not use the client of its parent because connections cannot
+    be shared between processes."""
+    key = (os.getpid(), host, port)
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = Elasticsearch([{'host': host, 'port': port}], **CLIENT)
+        return _CLIENTS[key]
+
+
+def close_clients():
+    """Close the connections of all clients created by get_client()."""
+    with _CLIENTS_LOCK:
+        for client in _CLIENTS.values():
+            client.close()
+        _CLIENTS.clear()
+
+
+# Documents that the cluster rejects during a bulk load because it is too busy
+# (status 429) are sent again up to LOAD_RETRIES times, after waiting for
+# RETRY_BACKOFF seconds, doubled for each later attempt.
+LOAD_RETRIES = 3
+RETRY_BACKOFF = 2
+
+# number of queries in each _msearch request sent by Index.msearch() and the
+# number of those requests that are sent at the same time
+MSEARCH_BATCH_SIZE = 50
+MSEARCH_CONCURRENCY = 4
+
+# index settings used while bulk loading, refreshing is switched off so segments
+# are not created for every chunk and replicas are created after the load
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
 
 class Index(object):
 
     def __init__(self, index_name, host='localhost', port=9200, index_elements=None):
         self.index = index_name
-        self.es = Elasticsearch([{'host': host, 'port': port}])
+        self.es = get_client(host, port)
         if index_elements is not None:
             self.load(index_elements)
 
@@ -25,7 +94,6 @@ class Index(object):
         for i, element in enumerate(elements):
             docid = element.get('docid')
             identifier = i if docid is None else docid
-            print(docid)
             yield {
                 "_type":"_doc",
                 "_id":identifier,
@@ -35,45 +103,290 @@ class Index(object):
     def load(self, elements):
         helpers.bulk(self.es, self.to_bulk_iterable(elements))
 
+    def load_streaming(self, elements, threads=4, chunk_size=500,
+                       max_chunk_bytes=10485760, progress=None, max_retries=LOAD_RETRIES):
+        """Load elements, which can be any iterable including a generator, using
+        the parallel bulk loader with the given number of threads, or the
+        streaming bulk loader if threads is 1. Elements are consumed lazily so
+        memory use does not depend on the number of elements. Documents that
+        are rejected because the cluster is too busy are collected and sent
+        again, up to max_retries times, as soon as there are chunk_size of
+        them and at the end. Throughput, failures and retries are reported to
+        the progress reporter after each chunk. Returns a pair of the number
+        of indexed documents and a list of failures."""
+        if progress is None:
+            progress = Progress('load_index')
+        indexed = 0
+        failures = []
+        rejected = []
+        chunk = 0
+        chunk_docs = 0
+        chunk_failures = 0
+        t_chunk = time.time()
+        results = self._bulk(self.to_bulk_iterable(elements), threads, chunk_size, max_chunk_bytes)
+        for action, ok, info in results:
+            chunk_docs += 1
+            if ok:
+                indexed += 1
+                progress.add(docs=1)
+            elif max_retries and _status(info) == 429:
+                rejected.append(action)
+            else:
+                chunk_failures += 1
+                failures.append(info)
+                progress.add(docs=0, errors=1)
+            if len(rejected) >= chunk_size:
+                retried, retry_failures = self._retry(rejected, chunk_size, max_chunk_bytes,
+                                                      max_retries, progress)
+                indexed += retried
+                failures.extend(retry_failures)
+                rejected = []
+            if chunk_docs == chunk_size:
+                chunk += 1
+                self._report_chunk(progress, chunk, chunk_docs, chunk_failures, t_chunk)
+                chunk_docs = chunk_failures = 0
+                t_chunk = time.time()
+        if rejected:
+            retried, retry_failures = self._retry(rejected, chunk_size, max_chunk_bytes,
+                                                  max_retries, progress)
+            indexed += retried
+            failures.extend(retry_failures)
+        if chunk_docs:
+            self._report_chunk(progress, chunk + 1, chunk_docs, chunk_failures, t_chunk)
+        progress.finish()
+        return indexed, failures
+
+    def _bulk(self, actions, threads, chunk_size, max_chunk_bytes):
+        """Generator over (action, ok, info) triples for the results of a bulk load.
+        Both bulk loaders return results in the order of the actions, so the
+        actions that were sent but have no result yet are kept in a queue."""
+        sent = deque()
+        def send():
+            for action in actions:
+                sent.append(action)
+                yield action
+        if threads > 1:
+            results = helpers.parallel_bulk(
+                self.es, send(), thread_count=threads, chunk_size=chunk_size,
+                max_chunk_bytes=max_chunk_bytes, raise_on_error=False)
+        else:
+            results = helpers.streaming_bulk(
+                self.es, send(), chunk_size=chunk_size,
+                max_chunk_bytes=max_chunk_bytes, raise_on_error=False)
+        for ok, info in results:
+            yield sent.popleft(), ok, info
+
+    def _retry(self, actions, chunk_size, max_chunk_bytes, max_retries, progress):
+        """Send actions that were rejected again, at most max_retries times, and
+        return the number of documents indexed and a list of failures, which
+        includes the documents that were still rejected after the last try."""
+        indexed = 0
+        failures = []
+        for attempt in range(max_retries):
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+            progress.add(docs=0, retries=len(actions))
+            rejected = []
+            for action, ok, info in self._bulk(actions, 1, chunk_size, max_chunk_bytes):
+                if ok:
+                    indexed += 1
+                    progress.add(docs=1)
+                elif _status(info) == 429 and attempt + 1 < max_retries:
+                    rejected.append(action)
+                else:
+                    failures.append(info)
+                    progress.add(docs=0, errors=1)
+            if not rejected:
+                break
+            actions = rejected
+        return indexed, failures
+
+    def create(self, mappings):
+        """Delete the index if it exists and create it again with the settings and
+        mappings in a dictionary like the one in data/mapping.json."""
+        self.es.indices.delete(index=self.index, ignore=[400, 404])
+        self.es.indices.create(index=self.index, body=mappings)
+
+    def start_bulk_load(self):
+        """Change the index settings for a bulk load, which switches off refreshing
+        and replicas, and return the settings that were changed so they can be
+        restored with end_bulk_load(). A setting that was not set explicitly is
+        returned as None, which restores the default. The index is created with
+        default settings if it does not exist."""
+        if not self.es.indices.exists(index=self.index):
+            self.es.indices.create(index=self.index)
+        settings = self.es.indices.get_settings(index=self.index)[self.index]['settings']['index']
+        saved = {name: settings.get(name) for name in BULK_LOAD_SETTINGS}
+        self.es.indices.put_settings(index=self.index, body={'index': BULK_LOAD_SETTINGS})
+        return saved
+
+    def end_bulk_load(self, saved):
+        """Restore the settings returned by start_bulk_load() and refresh the index
+        so all loaded documents can be searched."""
+        self.es.indices.put_settings(index=self.index, body={'index': saved})
+        self.es.indices.refresh(index=self.index)
+
+    def size(self):
+        """Return the number of documents in the index and the size in bytes of its
+        primary shards, after flushing so all documents are written to disk."""
+        self.es.indices.refresh(index=self.index)
+        self.es.indices.flush(index=self.index)
+        stats = self.es.indices.stats(index=self.index, metric='docs,store')
+        primaries = stats['indices'][self.index]['primaries']
+        return primaries['docs']['count'], primaries['store']['size_in_bytes']
+
+    @staticmethod
+    def _report_chunk(progress, chunk, docs, failures, t0):
+        elapsed = time.time() - t0
+        rate = docs / elapsed if elapsed else 0
+        progress.report(force=False, chunk=chunk, chunk_docs=docs,
+                        chunk_failures=failures, chunk_docs_per_sec=round(rate, 2))
+
     def get(self, message, doc_id, dribble=False):
         print("\n{}".format(message))
+        doc = self.get_document(doc_id)
+        if doc is None:
+            print("Document %s not found in %s" % (doc_id, self.index))
+        elif dribble:
+            pprint(doc['_source'])
+        return doc
+
+    def get_document(self, doc_id):
+        """Return the document with doc_id, or None if there is no such document."""
         try:
-            doc = self.es.get(index=self.index, id=doc_id)
-            if dribble:
-                pprint(doc['_source'])
-            return doc
-        except NotFoundError as e:
-            print(e)
+            return self.es.get(index=self.index, id=doc_id)
+        except NotFoundError:
+            return None
 
     def search(self, message, query, dribble=False):
         print("\n{}".format(message))
-        result = Result(self.es.search(index=self.index, body=query))
+        result = self.query(query)
         result.print_sources(dribble)
         return result
 
+    def query(self, query, **params):
+        """Run a query and return the Result, any keyword arguments are handed to
+        the search API, for example size or _source."""
+        return Result(self.es.search(index=self.index, body=query, **params))
+
+    def msearch(self, queries, batch_size=MSEARCH_BATCH_SIZE,
+                concurrency=MSEARCH_CONCURRENCY):
+        """Run a list of queries with multi-search requests of at most batch_size
+        queries, sending at most concurrency requests at the same time over the
+        shared client. Returns a list with the Result of each query, in the
+        order of the queries. A query that failed gives a Result with an error
+        instead of hits, if a whole request failed all its queries get the
+        error of that request."""
+        batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+        if concurrency > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(self._msearch_batch, batches))
+        else:
+            results = [self._msearch_batch(batch) for batch in batches]
+        return [result for batch_results in results for result in batch_results]
+
+    def _msearch_batch(self, queries):
+        body = []
+        for query in queries:
+            body.append({})
+            body.append(query)
+        try:
+            responses = self.es.msearch(index=self.index, body=body)['responses']
+        except Exception as e:
+            return [_error_result(e) for query in queries]
+        return [Result(response) for response in responses]
+
+
+def _error_result(exception):
+    """Return a Result for a query that failed with an exception."""
+    return Result({'error': {'type': type(exception).__name__, 'reason': str(exception)}})
+
+
+def _status(info):
+    """Return the status of a bulk load result."""
+    return next(iter(info.values())).get('status')
+
+
+class AsyncIndex(object):
+
+    """Asyncio version of the query methods of Index. The client is created with
+    the CLIENT settings for each AsyncIndex because asyncio connections belong
+    to an event loop, so an AsyncIndex should be used with one event loop and
+    closed when done."""
+
+    def __init__(self, index_name, host='localhost', port=9200):
+        if AsyncElasticsearch is None:
+            raise ImportError("AsyncIndex needs the aiohttp package")
+        self.index = index_name
+        self.es = AsyncElasticsearch([{'host': host, 'port': port}], **CLIENT)
+
+    async def get(self, doc_id):
+        """Return the document with doc_id, or None if there is no such document."""
+        try:
+            return await self.es.get(index=self.index, id=doc_id)
+        except NotFoundError:
+            return None
+
+    async def query(self, query, **params):
+        """Run a query and return the Result."""
+        return Result(await self.es.search(index=self.index, body=query, **params))
+
+    async def search_all(self, queries, concurrency=None, **params):
+        """Run all queries concurrently and return a list with the Result of each
+        query, in the order of the queries. At most concurrency queries are sent
+        at the same time, by default as many as the client keeps connections
+        open. A query that failed gives a Result with an error instead of hits,
+        like in Index.msearch()."""
+        semaphore = asyncio.Semaphore(concurrency or CLIENT['maxsize'])
+        async def bounded_query(query):
+            async with semaphore:
+                try:
+                    return await self.query(query, **params)
+                except Exception as e:
+                    return _error_result(e)
+        return await asyncio.gather(*[bounded_query(query) for query in queries])
+
+    async def close(self):
+        await self.es.close()
+
 
 class Result(object):
 
-    """Class to wrap an ElasticSearch result."""
+    """Class to wrap an ElasticSearch result. The result of a failed query in a
+    multi-search has no hits and the error in the error attribute, for other
+    results the error is None."""
     
     def __init__(self, result):
         self.result = result
-        self.hits = [Hit(hit) for hit in self.result['hits']['hits']]
-        self.total_hits = self.result['hits']['total']['value']
+        self.error = result.get('error')
+        if self.error is None:
+            self.hits = [Hit(hit) for hit in self.result['hits']['hits']]
+            self.total_hits = self.result['hits']['total']['value']
+        else:
+            self.hits = []
+            self.total_hits = 0
         self.sources = [hit.source for hit in self.hits]
 
+    @property
+    def failed(self):
+        return self.error is not None
+
     def write(self):
         fname = "{:04d}.txt".format(nextint())
         with open(fname, 'w', encoding='utf8') as fh:
             fh.write(json.dumps(self.result, sort_keys=True, indent=4))
 
     def pp(self):
+        if self.failed:
+            print("\n    Failed: {}".format(self.error))
+            return
         print("\n    Number of hits: {:d}".format(self.total_hits))
         for hit in self.hits:
             print("    {}  {:.4f}  {}".format(hit.docid, hit.score, hit.docname[:80]))
 
     def print_sources(self, dribble):
-        if dribble:
+        if self.failed:
+            print('   Failed: {}'.format(self.error))
+        elif dribble:
             sources = self.sources
             print('   Got {:d} hits'.format(self.total_hits))
             for source in self.sources:
@@ -104,7 +417,7 @@ if __name__ == '__main__':
         {"name": {"first": "jane", "last": "doe"}, "age": 27, "interests": ["rap music yeah"]},
         {"name": {"first": "june", "last": "doe"}, "age": 65, "interests": ["forestry"]}]
 
-    idx = Index('test_entities', entities)
+    idx = Index('test_entities', index_elements=entities)
 
     queries = [
 
@@ -139,5 +452,7 @@ if __name__ == '__main__':
         ]
 
     idx.get("Retrieving document with id=1", 1, dribble=True)
-    for message, query in queries:
-        idx.search(message, query, dribble=True)
+    results = idx.msearch([query for message, query in queries])
+    for (message, query), result in zip(queries, results):
+        print("\n{}".format(message))
+        result.print_sources(True)
@@ -11,23 +11,89 @@ FILELIST (which has the relative paths from DATA_DIR/lif) only using the lines
 from BEGIN to END. Both BEGIN and END default to 1. The model is written to
 TOPICS_DIR.
 
-$ python generate_topics.py -d DATA_DIR -f FILELIST -b BEGIN -e END --crash?
+$ python3 generate_topics.py --train --stream -d DATA_DIR -f FILELIST -b BEGIN -e END
+
+Train a model without keeping the tokenized documents or the corpus in memory.
+The LIF files are read lazily each time the documents are needed, unless
+--token-cache FILE is given, in which case the first pass writes the tokens of
+each document to FILE and later passes read them from there. The corpus is
+saved in Matrix Market format in TOPICS_DIR and training streams it from disk.
+
+Adding --workers N to either of the two training commands trains with the
+multicore LDA implementation using N worker processes.
+
+$ python3 generate_topics.py --update -d DATA_DIR -f FILELIST -b BEGIN -e END
+
+Update the existing model with the documents from FILELIST without retraining
+from scratch, for example to fold in a new CORD-19 release. The dictionary is not
+changed, so words that are not in it are ignored.
+
+All training commands end with a report of the wall-clock time, perplexity and
+u_mass coherence of the model on the training documents.
+
+$ python generate_topics.py -d DATA_DIR -f FILELIST -b BEGIN -e END --crash? --metrics FILE?
 
 Run the topic model created with --train to generate topics for the files in
 DATA_DIR/lif as filtered by FILELIST, BEGIN and END. Results are written to
 DATA_DIR/top. Usually errors are trapped, adding the optional --crash option
-makes the script exit with an error.
+makes the script exit with an error. With --metrics, progress metrics are
+appended to FILE as JSON lines. Output is pretty-printed unless --compact is
+used, --gzip compresses output files and --packed writes them to a packed store
+if DATA_DIR/top does not exist yet (see store.py). Input LIF files may be
+compressed or in a packed store.
+
+The inputs of each document, which are the LIF file and the versions of the
+model, dictionary, lemma table and tokenizer, are recorded in DATA_DIR/top.manifest
+(see manifest.py). With --incremental, documents are skipped if their output
+exists and their inputs did not change, so only new or changed documents are
+processed after a new CORD-19 release and only the remaining documents after an
+interrupted run. Retraining the model makes all documents change.
+
+$ python generate_topics.py -d DATA_DIR -f FILELIST --shard I/N --state FILE (--resume)
+
+The filelist is processed by the batch runner in runner.py. With --shard I/N only
+lines I, I+N, I+2N and so on are used, so N processes or machines can each take
+one shard without overlap. With --state FILE progress is checkpointed to FILE
+every 1000 lines (change this with --checkpoint N) and the files that failed are
+listed in FILE.retry, which can be given as the filelist of a later run. With
+--resume the run continues from the last checkpoint in FILE.
 
 On the COVID dataset this processes about 10-12 documents per second.
 
+$ python generate_topics.py -d DATA_DIR -f FILELIST -b BEGIN -e END --workers N
+
+Generate topics with a pool of N processes. Files from FILELIST are handed out
+in batches of --batch-size files (default 50). Each worker loads the model and
+dictionary once, the model is loaded with mmap='r' so that model arrays that
+gensim stored in separate files are shared between workers.
+
+$ python generate_topics.py --build-lemmas -d DATA_DIR -f FILELIST -b BEGIN -e END
+
+Build a lemma table from the words in the LIF files from FILELIST and save it to
+TOPICS_DIR. The table has the lemma of each word that occurs at least twice,
+keyed on the lowercased word as it appears in the text. When the table exists,
+lemmatization in training and inference first looks up words in the table and
+only falls back to WordNet, with an in-memory LRU cache, for words not in the
+table.
+
+All commands take --tokenizer nltk|regex to select the tokenizer used to prepare
+text for LDA. The default nltk tokenizer uses word_tokenize(), the regex
+tokenizer uses a compiled regular expression and does tokenization, filtering
+and lemmatization in one pass, it is several times faster but may give slightly
+different tokens (see benchmark.py --tokenizers).
+
 """
 
 
 import os
+import re
 import sys
 import codecs
 import pickle
+import time
 import getopt
+from collections import Counter
+from functools import lru_cache
 
 import gensim
 
@@ -36,22 +102,66 @@ from nltk import word_tokenize
 from nltk.corpus import wordnet as wn
 
 from lif import LIF, View, Annotation
-from utils import elements, ensure_directory, time_elapsed, print_element
+from utils import elements, time_elapsed, print_errors, Progress
+from utils import set_output_options, get_settings, apply_settings
+from runner import BatchRunner, RUNNER_OPTIONS, set_runner_options
+from store import get_store, close_stores, document_key
+from manifest import Manifest, get_manifest, close_manifests
+import cache
 
 
 TOPICS_DIR = "data/topics"
 CORPUS_FILE = os.path.join(TOPICS_DIR, 'corpus.pkl')
+CORPUS_MM_FILE = os.path.join(TOPICS_DIR, 'corpus.mm')
 DICTIONARY_FILE = os.path.join(TOPICS_DIR, 'dictionary.gensim')
 MODEL_FILE = os.path.join(TOPICS_DIR, 'model5.gensim')
+LEMMA_FILE = os.path.join(TOPICS_DIR, 'lemmas.pkl')
 
 NUM_TOPICS = 100
+BATCH_SIZE = 50
+LEMMA_CACHE_SIZE = 100000
 
 STOPWORDS = set(nltk.corpus.stopwords.words('english'))
 
+# especially the first two occur in most abstracts so let's ignore them
+WORDS_TO_IGNORE = {'title', 'abstract', 'result', 'study'}
+
+# tokenizer used by prepare_text_for_lda(), either 'nltk' or 'regex'
+TOKENIZER = 'nltk'
+
+# characters that word_tokenize() always splits tokens on, together with the
+# characters that it only splits on in some contexts, which TOKEN_RE handles
+_SPLIT_CHARS = r"\s,:.'\-;@#$%&?!*()\[\]{}<>\"`\u00ab\u00bb\u201c\u201d\u2018\u2019\u201e\u2012-\u2015"
+
+# Tokens as word_tokenize() makes them, for the tokens that are longer than four
+# characters. Like word_tokenize() this keeps commas and colons followed by a
+# digit (1,000,000 and 10:30), slashes and other symbols (RNA/DNA, p=0.05),
+# hyphens and periods inside a token, and apostrophes that do not start a
+# contraction. Unlike word_tokenize() it does not split sentences first, so it
+# always drops the period at the end of a token, also for abbreviations like
+# approx., and it splits off n't as 't, so wouldn't gives wouldn and not would.
+TOKEN_RE = re.compile(
+    r"(?:[^{split}]+"
+    r"|[,:](?=\d)"
+    r"|(?<!\.)\.(?=[^{split}])"
+    r"|(?<!-)-(?!-)"
+    r"|(?<=\w)'(?=[\w-])(?!(?:[sSmMdDtT]|ll|LL|re|RE|ve|VE)\b)"
+    r")+".format(split=_SPLIT_CHARS))
+
+# words that word_tokenize() splits in two short tokens, like can not
+SPLIT_WORDS = {'cannot', 'gimme', 'gonna', 'gotta', 'lemme', 'wanna'}
+
+# words that occur fewer times than this are not put in the lemma table
+LEMMA_MIN_COUNT = 2
+
+# lemmas loaded from LEMMA_FILE by load_lemma_table()
+LEMMAS = {}
+
 
 @time_elapsed
-def train_model(data_dir, filelist, start, end):
+def train_model(data_dir, filelist, start, end, workers=1):
     """Build a model from scratch using the files as specified in the arguments."""
+    t0 = time.time()
     print("\nCollecting data")
     text_data = _collect_data(data_dir, filelist, start, end)
     print("\nLoading text data into dictionary")
@@ -60,29 +170,145 @@ def train_model(data_dir, filelist, start, end):
     corpus = [dictionary.doc2bow(text) for text in text_data]
     print(dictionary)
     print("\nCreating LDA model")
-    ldamodel = gensim.models.ldamodel.LdaModel(corpus, num_topics=NUM_TOPICS,
-                                               id2word=dictionary, passes=15)
+    ldamodel = create_model(corpus, dictionary, workers)
     print("\nSaving dictionary, corpus and LDA model to disk\n")
-    pickle.dump(corpus, open(CORPUS_FILE, 'wb'))
+    with open(CORPUS_FILE, 'wb') as fh:
+        pickle.dump(corpus, fh)
+    dictionary.save(DICTIONARY_FILE)
+    ldamodel.save(MODEL_FILE)
+    report_model('train', ldamodel, corpus, dictionary, time.time() - t0, workers)
+
+
+@time_elapsed
+def train_model_streaming(data_dir, filelist, start, end, token_cache=None, workers=1):
+    """Build a model from scratch like train_model(), but stream documents from
+    disk so that memory use does not depend on the number of documents."""
+    t0 = time.time()
+    load_lemma_table()
+    texts = LifTexts(data_dir, filelist, start, end, token_cache=token_cache)
+    print("\nLoading text data into dictionary")
+    dictionary = gensim.corpora.Dictionary(texts)
+    print(dictionary)
+    print("\nSaving bag-of-words corpus to %s" % CORPUS_MM_FILE)
+    gensim.corpora.MmCorpus.serialize(CORPUS_MM_FILE, BowCorpus(texts, dictionary))
+    corpus = gensim.corpora.MmCorpus(CORPUS_MM_FILE)
+    print("\nCreating LDA model")
+    ldamodel = create_model(corpus, dictionary, workers)
+    print("\nSaving dictionary and LDA model to disk\n")
     dictionary.save(DICTIONARY_FILE)
     ldamodel.save(MODEL_FILE)
+    report_model('train-stream', ldamodel, corpus, dictionary, time.time() - t0, workers)
+
+
+@time_elapsed
+def update_model(data_dir, filelist, start, end):
+    """Update the saved model with the documents specified by the arguments and
+    save it. Uses the saved dictionary, words not in it are ignored."""
+    t0 = time.time()
+    load_lemma_table()
+    lda = load_model()
+    dictionary = load_dictionary()
+    texts = LifTexts(data_dir, filelist, start, end)
+    corpus = [bow for bow in BowCorpus(texts, dictionary) if bow]
+    print("\nUpdating LDA model with %d documents" % len(corpus))
+    lda.update(corpus)
+    lda.save(MODEL_FILE)
+    report_model('update', lda, corpus, dictionary, time.time() - t0)
+
+
+def create_model(corpus, dictionary, workers=1):
+    """Train an LDA model on the corpus, using the multicore implementation if
+    workers > 1."""
+    if workers > 1:
+        return gensim.models.ldamulticore.LdaMulticore(
+            corpus, num_topics=NUM_TOPICS, id2word=dictionary, passes=15,
+            workers=workers)
+    return gensim.models.ldamodel.LdaModel(corpus, num_topics=NUM_TOPICS,
+                                           id2word=dictionary, passes=15)
+
+
+def report_model(mode, lda, corpus, dictionary, elapsed, workers=1):
+    """Print wall-clock time, perplexity and u_mass coherence for a model that was
+    created or updated using corpus."""
+    perplexity = 2 ** -lda.log_perplexity(corpus)
+    coherence = gensim.models.CoherenceModel(
+        model=lda, corpus=corpus, dictionary=dictionary,
+        coherence='u_mass').get_coherence()
+    print("\nmode=%s  workers=%d  time=%.2f  perplexity=%.2f  coherence=%.4f"
+          % (mode, workers, elapsed, perplexity, coherence))
+
+
+class LifTexts(object):
+
+    """Iterable over the tokenized texts of the LIF files in the filelist. Files
+    are read again for each iteration, unless a token cache file is given, in
+    which case the first iteration writes one line with tokens for each
+    document to the cache and later iterations read the cache."""
+
+    def __init__(self, data_dir, filelist, start, end, token_cache=None):
+        self.data_dir = data_dir
+        self.filelist = filelist
+        self.start = start
+        self.end = end
+        self.token_cache = token_cache
+        self.cached = False
+
+    def __iter__(self):
+        if self.cached:
+            with open(self.token_cache, encoding='utf8') as fh:
+                for line in fh:
+                    yield line.split()
+        elif self.token_cache is not None:
+            with open(self.token_cache, 'w', encoding='utf8') as fh:
+                for tokens in self._read_lif_files():
+                    fh.write(' '.join(tokens) + "\n")
+                    yield tokens
+            self.cached = True
+        else:
+            yield from self._read_lif_files()
+
+    def _read_lif_files(self):
+        progress = Progress('collect_data', total=self.end - self.start + 1)
+        lif_store = get_store(self.data_dir, 'lif')
+        for n, fname in elements(self.filelist, self.start, self.end):
+            key = document_key(fname)
+            if key not in lif_store:
+                progress.add(docs=0)
+                continue
+            lif = LIF.from_store(lif_store, key, lean=True)
+            progress.add(bytes=len(lif.text.value))
+            yield prepare_text_for_lda(lif.text.value, ignore=WORDS_TO_IGNORE)
+        progress.finish()
+
+
+class BowCorpus(object):
+
+    """Iterable over the bag-of-words vectors of an iterable of texts."""
+
+    def __init__(self, texts, dictionary):
+        self.texts = texts
+        self.dictionary = dictionary
+
+    def __iter__(self):
+        for text in self.texts:
+            yield self.dictionary.doc2bow(text)
 
 
 def _collect_data(data_dir, filelist, start, end):
+    load_lemma_table()
     all_data = []
-    # especially the first two occur  in most abstracts so let's ignore them
-    words_to_ignore = {'title', 'abstract', 'result', 'study'}
+    progress = Progress('collect_data', total=end - start + 1)
+    lif_store = get_store(data_dir, 'lif')
     for n, fname in elements(filelist, start, end):
-        print("    %07d  %s" % (n, fname))
-        #fpath = os.path.join(data_dir, 'lif', fname[:-5] + '.lif')
-        fpath = os.path.join(data_dir, 'lif', fname)
-        try:
-            lif = LIF(fpath)
-            text_data = prepare_text_for_lda(lif.text.value)
-            text_data = [w for w in text_data if w not in words_to_ignore]
-            all_data.append(text_data)
-        except FileNotFoundError:
-            pass
+        key = document_key(fname)
+        if key not in lif_store:
+            progress.add(docs=0)
+            continue
+        lif = LIF.from_store(lif_store, key, lean=True)
+        text_data = prepare_text_for_lda(lif.text.value, ignore=WORDS_TO_IGNORE)
+        all_data.append(text_data)
+        progress.add(bytes=len(lif.text.value))
+    progress.finish()
     token_count = sum([len(d) for d in all_data])
     print('\nToken count = %d' % token_count)
     return all_data
@@ -97,48 +323,158 @@ def print_model(lda=None):
         print('  ', topic)
 
 
-def load_model():
-    return gensim.models.ldamodel.LdaModel.load(MODEL_FILE)
+def load_model(mmap=None):
+    return gensim.models.ldamodel.LdaModel.load(MODEL_FILE, mmap=mmap)
 
 
 def load_dictionary():
     return gensim.corpora.Dictionary.load(DICTIONARY_FILE)
 
 
-@time_elapsed
-def generate_topics(data_dir, filelist, start, end, crash=False):
-    lda = load_model()
-    topic_idx = {topic_id: topic for topic_id, topic
-                 in lda.print_topics(num_topics=NUM_TOPICS)}
-    dictionary = load_dictionary()
+def load_lemma_table():
+    """Load the lemma table into LEMMAS if it exists and return the table."""
+    if not LEMMAS and os.path.exists(LEMMA_FILE):
+        with open(LEMMA_FILE, 'rb') as fh:
+            LEMMAS.update(pickle.load(fh))
+    return LEMMAS
+
+
+def build_lemma_table(data_dir, filelist, start, end, min_count=LEMMA_MIN_COUNT):
+    """Create a table with lemmas for the words in the LIF files from the filelist
+    and save it to LEMMA_FILE. The table is keyed on the lowercased tokens that
+    get_lemma() is called with, so only tokens of more than four characters
+    that are not stopwords are used, and only those that occur at least
+    min_count times, rarer words are left to the LRU cache."""
+    counts = Counter()
+    progress = Progress('build_lemmas', total=end - start + 1)
+    lif_store = get_store(data_dir, 'lif')
     for n, fname in elements(filelist, start, end):
-        print_element(n, fname)
-        if crash:
-            generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary)
-        else:
-            try:
-                generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary)
-            except Exception as e:
-                print('ERROR:', Exception, e)
+        key = document_key(fname)
+        if key not in lif_store:
+            progress.add(docs=0)
+            continue
+        text = LIF.from_store(lif_store, key, lean=True).text.value
+        counts.update(tok.lower() for tok in TOKEN_RE.findall(text)
+                      if len(tok) > 4 and tok not in STOPWORDS)
+        progress.add(bytes=len(text))
+    progress.finish()
+    lemmas = {word: _morphy(word) for word, count in counts.items() if count >= min_count}
+    with open(LEMMA_FILE, 'wb') as fh:
+        pickle.dump(lemmas, fh)
+    print("Saved %d lemmas to %s" % (len(lemmas), LEMMA_FILE))
+    return lemmas
+
+
+def load_topic_index(lda):
+    return {topic_id: topic for topic_id, topic
+            in lda.print_topics(num_topics=NUM_TOPICS)}
 
 
-def generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary):
+@time_elapsed
+def generate_topics(data_dir, filelist, start, end, crash=False, workers=1,
+                    batch_size=BATCH_SIZE):
+    """Generate topics for the files in the filelist, using a pool of processes if
+    workers > 1. Returns a list of (fname, error) pairs."""
+    runner = BatchRunner(filelist, start, end)
+    initargs = ('r', TOKENIZER, get_settings()) if workers > 1 else ()
+    errors = runner.run('generate_topics', _generate_batch,
+                        lambda fnames: (data_dir, fnames, crash),
+                        workers=workers, batch_size=batch_size,
+                        initializer=_init_worker, initargs=initargs)
+    close_stores()
+    close_manifests()
+    get_manifest(data_dir, 'top').compact()
+    print_errors(errors)
+    return errors
+
+
+def model_version():
+    """Return a string that changes when the model, the dictionary, the lemma
+    table or the tokenizer changes, which are all used for generating topics."""
+    hashes = [cache.content_hash(fname) for fname in (MODEL_FILE, DICTIONARY_FILE, LEMMA_FILE)
+              if os.path.exists(fname)]
+    return ':'.join(hashes + [TOKENIZER])
+
+
+# model, topic index and dictionary used by _generate_batch(), these are set
+# once for each worker process by _init_worker()
+_WORKER_MODEL = {}
+
+
+def _init_worker(mmap=None, tokenizer=None, settings=None):
+    global TOKENIZER
+    if settings is not None:
+        apply_settings(settings)
+    if tokenizer is not None:
+        TOKENIZER = tokenizer
+    load_lemma_table()
+    lda = load_model(mmap=mmap)
+    _WORKER_MODEL['lda'] = lda
+    _WORKER_MODEL['topic_idx'] = load_topic_index(lda)
+    _WORKER_MODEL['dictionary'] = load_dictionary()
+    _WORKER_MODEL['version'] = model_version()
+
+
+def _generate_batch(job):
+    """Generate topics for a batch of file names using the model loaded by
+    _init_worker(). Returns the number of documents processed, the number of
+    characters written and a list of (fname, error) pairs."""
+    data_dir, fnames, crash = job
+    lda = _WORKER_MODEL['lda']
+    topic_idx = _WORKER_MODEL['topic_idx']
+    dictionary = _WORKER_MODEL['dictionary']
+    version = _WORKER_MODEL['version']
+    docs = 0
+    size = 0
+    errors = []
+    for fname in fnames:
+        try:
+            size += generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary,
+                                             version=version)
+            docs += 1
+        except Exception as e:
+            if crash:
+                raise
+            errors.append((fname, "%s: %s" % (type(e).__name__, e)))
+    return docs, size, errors
+
+
+def generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary, version=None):
+    """Add topics to fname and write the result to the top store, returns the
+    number of characters written. If the version of the model is given the
+    inputs are recorded in the manifest of the top store and the file is
+    skipped if its inputs did not change."""
+    key = document_key(fname)
+    lif_store = get_store(data_dir, 'lif')
+    if key not in lif_store:
+        print("Warning: file '%s' does not exist" % fname)
+        return 0
+    lif_data = lif_store.read(key)
+    top_store = get_store(data_dir, 'top')
+    if version is not None:
+        manifest = get_manifest(data_dir, 'top')
+        signature = Manifest.signature(lif_data, version)
+        if manifest.is_current(key, signature) and key in top_store:
+            return 0
+    lif_in = LIF(json_string=lif_data, lean=True)
+    lif_out = create_topics_lif(lif_in, fname, lda, topic_idx, dictionary)
+    size = top_store.write(key, lif_out.as_json(), newline=True)
+    if version is not None:
+        manifest.record(key, signature)
+    return size
+
+
+def create_topics_lif(lif_in, fname, lda, topic_idx, dictionary):
+    """Return a LIF object with a view with the topics for lif_in."""
     topic_id = 0
-    #fname_in = os.path.join(data_dir, 'lif', fname[:-5] + '.lif')
-    fname_in = os.path.join(data_dir, 'lif', fname)
-    fname_out = os.path.join(data_dir, 'top', fname[:-5] + '.lif')
-    ensure_directory(fname_out)
-    # lif_in = Container(fname_in).payload
-    try:
-        lif_in = LIF(fname_in)
-    except FileNotFoundError:
-        print("Warning: file '%s' does not exist" % fname_in)
-        return
-    lif_out = LIF(json_object=lif_in.as_json())
+    # start from an empty object rather than a copy of lif_in, which would
+    # create all its views only to throw them away
+    lif_out = LIF()
+    lif_out.text.language = lif_in.text.language
     # the following three are just to save some space, we get them from the lif
     # file anyway
     lif_out.text.value = None
-    lif_out.text.source = fname_in
+    lif_out.text.source = fname
     lif_out.metadata = {}
     topics_view = _create_view()
     lif_out.views = [topics_view]
@@ -152,13 +488,42 @@ def generate_topics_for_file(data_dir, fname, lda, topic_idx, dictionary):
         # print('   %3d  %.04f  %s' % (topic[0], topic[1], lemmas))
         topics_view.annotations.append(
             topic_annotation(topic, topic_id, lemmas))
-    lif_out.write(fname=fname_out, pretty=True)
+    return lif_out
 
 
-def prepare_text_for_lda(text):
+def prepare_text_for_lda(text, ignore=None, tokenizer=None):
+    """Return the list of lemmas from text that are used by the topic model. Only
+    tokens longer than four characters that are not stopwords are used and
+    lemmas in ignore are removed. Uses the tokenizer named by TOKENIZER unless
+    tokenizer is given."""
+    tokenizer = TOKENIZER if tokenizer is None else tokenizer
+    if tokenizer == 'regex':
+        return list(iter_lda_tokens(text, ignore))
     tokens = word_tokenize(text)
-    return [get_lemma(tok.lower()) for tok in tokens
-            if len(tok) > 4 and tok not in STOPWORDS]
+    lemmas = [get_lemma(tok.lower()) for tok in tokens
+              if len(tok) > 4 and tok not in STOPWORDS]
+    if ignore:
+        lemmas = [lemma for lemma in lemmas if lemma not in ignore]
+    return lemmas
+
+
+def iter_lda_tokens(text, ignore=None):
+    """Generator over the lemmas that prepare_text_for_lda() would return, using
+    the regular expression tokenizer and doing all filtering in one pass."""
+    ignore = () if ignore is None else ignore
+    stopwords = STOPWORDS
+    lemmas = LEMMAS
+    for match in TOKEN_RE.finditer(text):
+        tok = match.group()
+        if len(tok) > 4 and tok not in stopwords:
+            word = tok.lower()
+            if word in SPLIT_WORDS:
+                continue
+            lemma = lemmas.get(word)
+            if lemma is None:
+                lemma = _morphy(word)
+            if lemma not in ignore:
+                yield lemma
 
 
 def markable_annotation(lif_obj):
@@ -180,6 +545,12 @@ def topic_annotation(topic, topic_id, lemmas):
 
 
 def get_lemma(word):
+    lemma = LEMMAS.get(word)
+    return _morphy(word) if lemma is None else lemma
+
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def _morphy(word):
     lemma = wn.morphy(word)
     return word if lemma is None else lemma
 
@@ -211,6 +582,18 @@ def usage():
           + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST"
           + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST -s START -e END"
           + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --crash"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --metrics FILE"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --compact --gzip --packed"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --workers N --batch-size N"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --tokenizer regex"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --incremental"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --shard I/N"
+          + "\n    $ python3 generate_topics.py -d DATA_DIR -f FILELIST --state FILE (--resume) (--checkpoint N)"
+          + "\n    $ python3 generate_topics.py --build-lemmas -d DATA_DIR -f FILELIST -b START -e END"
+          + "\n    $ python3 generate_topics.py --train --stream (--token-cache FILE)"
+          + " -d DATA_DIR -f FILELIST -b START -e END"
+          + "\n    $ python3 generate_topics.py --train --workers N -d DATA_DIR -f FILELIST"
+          + "\n    $ python3 generate_topics.py --update -d DATA_DIR -f FILELIST -b START -e END"
           + "\n    $ python3 generate_topics.py --build -d DATA_DIR -f FILELIST -s START -e END"
           + "\n    $ python3 generate_topics.py (-h | --help)\n")
 
@@ -220,19 +603,40 @@ if __name__ == '__main__':
     data_dir = '/DATA/eager/sample-01000'
     filelist = '../../data/files-random-01000.txt'
 
-    options = dict(getopt.getopt(sys.argv[1:], 'd:f:b:e:h', ['crash', 'help', 'train'])[0])
+    options = dict(getopt.getopt(sys.argv[1:], 'd:f:b:e:h',
+                                 ['crash', 'help', 'train', 'metrics=',
+                                  'workers=', 'batch-size=', 'build-lemmas',
+                                  'tokenizer=', 'stream', 'token-cache=', 'update',
+                                  'compact', 'gzip', 'packed', 'incremental'] + RUNNER_OPTIONS)[0])
     data_dir = options.get('-d', data_dir)
     filelist = options.get('-f', filelist)
     start = int(options.get('-b', 1))
     end = int(options.get('-e', 1))
     train = True if '--train' in options else False
     crash = True if '--crash' in options else False
+    workers = int(options.get('--workers', 1))
+    batch_size = int(options.get('--batch-size', BATCH_SIZE))
     help_wanted = True if '-h' in options or '--help' in options else False
+    Progress.metrics_file = options.get('--metrics')
+    set_output_options(options)
+    set_runner_options(options)
+    Manifest.skip_unchanged = '--incremental' in options
+    TOKENIZER = options.get('--tokenizer', TOKENIZER)
 
     if help_wanted:
         usage()
+    elif '--build-lemmas' in options:
+        build_lemma_table(data_dir, filelist, start, end)
+    elif train and '--stream' in options:
+        train_model_streaming(data_dir, filelist, start, end,
+                              token_cache=options.get('--token-cache'), workers=workers)
+        print_model()
     elif train:
-        train_model(data_dir, filelist, start, end)
+        train_model(data_dir, filelist, start, end, workers=workers)
+        print_model()
+    elif '--update' in options:
+        update_model(data_dir, filelist, start, end)
         print_model()
     else:
-        generate_topics(data_dir, filelist, start, end, crash=crash)
+        generate_topics(data_dir, filelist, start, end, crash=crash,
+                        workers=workers, batch_size=batch_size)
@@ -22,6 +22,23 @@ To read and write a LIF object:
 Normaly there would be some manipulation of the LIF object between reading and
 writing, most typically by adding views.
 
+For faster loading of large files use the lean mode:
+
+>>> lif = LIF(infile, lean=True)
+
+This does not keep the JSON string around, uses orjson or ujson for parsing if
+one of them is installed, and only creates the View and Annotation objects when
+the views are first accessed.
+
+LIF objects can also be loaded from a document store:
+
+>>> lif = LIF.from_store(store, key)
+
+Files with names ending in .gz are read and written with gzip. The save()
+method writes a file using the output settings of the pipeline scripts (see
+utils.OUTPUT), which determine whether output is pretty-printed or compact and
+whether it is compressed.
+
 On the command line:
 
 $ python lif.py --container INFILE OUTFILE
@@ -36,48 +53,97 @@ import sys
 import codecs
 import json
 import subprocess
+from array import array
+from collections.abc import MutableSequence
+
+from utils import open_file, find_file, json_dumps, write_json
+
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = json
 
 
 class LappsObject(object):
 
-    def __init__(self, json_file, json_string, json_object):
+    def __init__(self, json_file, json_string, json_object, lean=False):
         self.json_file = json_file
-        self.json_file = json_string
+        self.json_string = None
         self.json_object = json_object
         if json_file is not None:
-            self.json_string = codecs.open(json_file).read()
+            json_file = find_file(json_file)
+        if json_file is not None and lean:
+            with open_file(json_file, 'rb') as fh:
+                self.json_object = fast_json.loads(fh.read())
+        elif json_file is not None:
+            with open_file(json_file) as fh:
+                self.json_string = fh.read()
             self.json_object = json.loads(self.json_string)
+        elif json_string is not None and lean:
+            self.json_object = fast_json.loads(json_string)
         elif json_string is not None:
             self.json_string = json_string
             self.json_object = json.loads(self.json_string)
-        elif json_object is not None:
-            self.json_string = None
-            self.json_object = json_object
 
     def write(self, fname=None, pretty=False):
+        """Write the object to fname or to the standard output and return the
+        number of characters written."""
         # first update the json object for those case where it has been changed
         json_obj = self.as_json()
         if pretty:
             s = json.dumps(json_obj, sort_keys=True, indent=4, separators=(',', ': '))
         else:
             s = json.dumps(json_obj)
-        fh = sys.stdout if fname is None else codecs.open(fname, 'w')
-        fh.write(s + "\n")
+        if fname is None:
+            sys.stdout.write(s + "\n")
+        else:
+            with open_file(fname, 'w') as fh:
+                fh.write(s + "\n")
+        return len(s) + 1
+
+    def save(self, fname):
+        """Write the object to fname using the output settings of the pipeline,
+        which may add .gz to the file name. Returns the number of characters
+        written."""
+        return write_json(self.as_json(), fname, newline=True)
 
 
 class LIF(LappsObject):
 
-    def __init__(self, json_file=None, json_string=None, json_object=None):
-        LappsObject.__init__(self, json_file, json_string, json_object)
+    """A LIF object. In lean mode the JSON string is not kept and views are only
+    created when the views variable is first used."""
+
+    def __init__(self, json_file=None, json_string=None, json_object=None, lean=False):
+        LappsObject.__init__(self, json_file, json_string, json_object, lean)
         self.context = "http://vocab.lappsgrid.org/context-1.0.0.jsonld"
         self.metadata = {}
         self.text = Text()
-        self.views = []
+        self._views = []
         if self.json_object is not None:
             self.metadata = self.json_object['metadata']
             self.text = Text(self.json_object['text'])
-            for v in self.json_object['views']:
-                self.views.append(View(v))
+            self._views = None if lean else self._create_views()
+
+    @classmethod
+    def from_store(cls, store, key, lean=False):
+        """Load the LIF object for key from a store (see store.py)."""
+        return cls(json_string=store.read(key), lean=lean)
+
+    @property
+    def views(self):
+        if self._views is None:
+            self._views = self._create_views()
+        return self._views
+
+    @views.setter
+    def views(self, views):
+        self._views = views
+
+    def _create_views(self):
+        return [View(v) for v in self.json_object['views']]
 
     def __str__(self):
         view_ids = [view.id for view in self.views]
@@ -96,8 +162,8 @@ class LIF(LappsObject):
              "views": [v.as_json() for v in self.views]}
         return d
 
-    def as_json_string(self):
-        return json.dumps(self.as_json(), sort_keys=True, indent=4, separators=(',', ': '))
+    def as_json_string(self, pretty=True):
+        return json_dumps(self.as_json(), pretty=pretty)
 
     def add_tarsqi_view(self, tarsqidoc):
         view = View()
@@ -172,29 +238,45 @@ class Text(object):
 
 class View(object):
 
+    """A view with its metadata and annotations. The annotations are kept in an
+    AnnotationStore, which behaves like a list of Annotation objects."""
+
     def __init__(self, id=None, json_obj=None):
         self.id = id
         self.metadata = {}
-        self.annotations = []
+        self._annotations = AnnotationStore()
         if json_obj is not None:
             self.id = json_obj['id']
             self.metadata = json_obj['metadata']
-            for a in json_obj['annotations']:
-                self.annotations.append(Annotation(a))
+            self.add_annotations_from_json(json_obj['annotations'])
+
+    @property
+    def annotations(self):
+        return self._annotations
+
+    @annotations.setter
+    def annotations(self, annotations):
+        self._annotations = AnnotationStore(annotations)
 
     def __len__(self):
-        return len(self.annotations)
+        return len(self._annotations)
 
     def __str__(self):
-        return "<View id={} with {:d} annotations>".format(self.id, len(self.annotations))
+        return "<View id={} with {:d} annotations>".format(self.id, len(self._annotations))
 
     def add(self, annotation):
-        self.annotations.append(annotation)
+        self._annotations.append(annotation)
+
+    def add_annotations_from_json(self, json_annotations):
+        """Add annotations from a list of JSON objects, without creating
+        Annotation objects."""
+        for json_obj in json_annotations:
+            self._annotations.append_json(json_obj)
 
     def as_json(self):
         d = {"id": self.id,
              "metadata": self.metadata,
-             "annotations": [a.as_json() for a in self.annotations]}
+             "annotations": self._annotations.as_json()}
         return d
 
     def pp(self):
@@ -205,6 +287,8 @@ class View(object):
 
 class Annotation(object):
 
+    __slots__ = ('id', 'type', 'start', 'end', 'target', 'text', 'features')
+
     def __init__(self, json_obj):
         self.id = json_obj['id']
         self.type = json_obj['@type']
@@ -233,6 +317,178 @@ class Annotation(object):
         return d
 
 
+def _column_property(column, convert=None):
+    """Return a property for an attribute of a StoredAnnotation that is kept in a
+    column of the store, convert is applied to values before they are stored."""
+    def get(self):
+        return getattr(self._store, column)[self._row]
+    def set(self, value):
+        getattr(self._store, column)[self._row] = value if convert is None else convert(value)
+    return property(get, set)
+
+
+def _offset_property(column, mask):
+    """Return a property for an offset of a StoredAnnotation, which is None when
+    the mask column of the store says the annotation has no such offset."""
+    def get(self):
+        store = self._store
+        return getattr(store, column)[self._row] if getattr(store, mask)[self._row] else None
+    def set(self, value):
+        store = self._store
+        getattr(store, mask)[self._row] = value is not None
+        getattr(store, column)[self._row] = 0 if value is None else value
+    return property(get, set)
+
+
+class StoredAnnotation(Annotation):
+
+    """An annotation in an AnnotationStore. Its attributes are read from and
+    written to the columns of the store, and two of them are equal if they are
+    for the same row of the same store, so an annotation taken from a view can
+    be changed, found and removed like one in a list."""
+
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def __eq__(self, other):
+        if not isinstance(other, StoredAnnotation):
+            return NotImplemented
+        return self._store is other._store and self._row == other._row
+
+    def __hash__(self):
+        return hash((id(self._store), self._row))
+
+    id = _column_property('ids')
+    type = _column_property('types', sys.intern)
+    start = _offset_property('starts', 'has_start')
+    end = _offset_property('ends', 'has_end')
+    target = _column_property('targets')
+    features = _column_property('features')
+
+    @property
+    def text(self):
+        return self._store.texts.get(self._row)
+
+    @text.setter
+    def text(self, text):
+        if text is None:
+            self._store.texts.pop(self._row, None)
+        else:
+            self._store.texts[self._row] = text
+
+
+class AnnotationStore(MutableSequence):
+
+    """Columnar storage for the annotations of a view, which behaves like a list of
+    Annotation objects. Identifiers, types, offsets, targets and features are
+    kept in parallel columns with one row for each annotation, with type
+    strings interned and offsets in integer arrays with a mask column that says
+    whether the annotation has the offset. The few texts that are set are kept
+    in a dictionary on the row.
+
+    Indexing or iterating over the store gives StoredAnnotation objects, which
+    read and write the columns. The order of the annotations is kept separately
+    from the rows, so inserting, removing and sorting annotations does not move
+    rows, and annotations taken from the store before stay valid. Adding an
+    annotation that is not from this store copies its values into a new row,
+    later changes to that annotation are not seen by the store. Rows of removed
+    annotations are not reused."""
+
+    __slots__ = ('ids', 'types', 'starts', 'ends', 'has_start', 'has_end',
+                 'targets', 'features', 'texts', 'order')
+
+    def __init__(self, annotations=()):
+        self.ids = []
+        self.types = []
+        self.starts = array('q')
+        self.ends = array('q')
+        self.has_start = bytearray()
+        self.has_end = bytearray()
+        self.targets = []
+        self.features = []
+        self.texts = {}
+        self.order = array('q')
+        for annotation in annotations:
+            self.append(annotation)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for row in self.order:
+            yield StoredAnnotation(self, row)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [StoredAnnotation(self, row) for row in self.order[i]]
+        return StoredAnnotation(self, self.order[i])
+
+    def __setitem__(self, i, annotation):
+        if isinstance(i, slice):
+            self.order[i] = array('q', [self._row_for(a) for a in annotation])
+        else:
+            self.order[i] = self._row_for(annotation)
+
+    def __delitem__(self, i):
+        del self.order[i]
+
+    def insert(self, i, annotation):
+        self.order.insert(i, self._row_for(annotation))
+
+    def append(self, annotation):
+        self.order.append(self._row_for(annotation))
+
+    def reverse(self):
+        self.order.reverse()
+
+    def sort(self, key=None, reverse=False):
+        annotations = sorted(self, key=key, reverse=reverse)
+        self.order = array('q', [annotation._row for annotation in annotations])
+
+    def append_json(self, json_obj):
+        self.order.append(self._add(json_obj['id'], json_obj['@type'], json_obj.get('start'),
+                                    json_obj.get('end'), json_obj.get('target'),
+                                    dict(json_obj.get('features', {}))))
+
+    def _row_for(self, annotation):
+        """Return the row for an annotation, adding a row if the annotation is
+        not from this store."""
+        if isinstance(annotation, StoredAnnotation) and annotation._store is self:
+            return annotation._row
+        row = self._add(annotation.id, annotation.type, annotation.start,
+                        annotation.end, annotation.target, annotation.features)
+        if annotation.text is not None:
+            self.texts[row] = annotation.text
+        return row
+
+    def _add(self, identifier, annotation_type, start, end, target, features):
+        self.ids.append(identifier)
+        self.types.append(sys.intern(annotation_type))
+        self.starts.append(0 if start is None else start)
+        self.ends.append(0 if end is None else end)
+        self.has_start.append(start is not None)
+        self.has_end.append(end is not None)
+        self.targets.append(target)
+        self.features.append(features)
+        return len(self.ids) - 1
+
+    def as_json(self):
+        annotations = []
+        for row in self.order:
+            d = {"id": self.ids[row], "@type": self.types[row], "features": self.features[row]}
+            if self.has_start[row]:
+                d["start"] = self.starts[row]
+            if self.has_end[row]:
+                d["end"] = self.ends[row]
+            if self.targets[row] is not None:
+                d["target"] = self.targets[row]
+            annotations.append(d)
+        return annotations
+
+
 class IdentifierFactory(object):
 
     identifiers = {'docelement': 0, 's': 0, 'lex': 0, 'ng': 0, 'vg': 0}
@@ -4,56 +4,114 @@ Loading documents into the elastic search demo index.
 
 Usage:
 
-$ python load_index.py INDEX_NAME DIRECTORY
-
-Load JSON documents from DIRECTORY into an index named INDEX_NAME.
+$ python load_index.py (OPTIONS) INDEX_NAME DIRECTORY (MAPPING_FILE)
+
+Load JSON documents from DIRECTORY into an index named INDEX_NAME, documents
+can be gzipped (with extension .json.gz) and DIRECTORY can also be a packed
+store (see store.py). If
+MAPPING_FILE is given the index is deleted and recreated with those mappings
+before loading.
+
+The mapping in data/mapping.json is made for the documents created by
+create_index.py. Identifiers, topic elements, containers, proteins and all the
+relation fields are keywords, as are string fields that are not in the mapping.
+Scoring norms are only kept for the text field. The index has one shard, which
+is plenty for the size of the CORD-19 dataset, and no replicas so that a single
+node cluster is green. Raise number_of_replicas for a production cluster with
+more than one node.
+
+Documents are streamed from the directory into the bulk loader, so only a few
+chunks are in memory at any time. Options:
+
+--threads N           number of bulk loader threads (default 4, 1 uses a
+                      single-threaded streaming bulk loader)
+--chunk-size N        maximum number of documents per bulk request (default 500)
+--max-chunk-bytes N   maximum size of a bulk request in bytes (default 10MB)
+--metrics FILE        append JSON lines with progress metrics to FILE
+--bulk                switch off refreshing and replicas while loading and
+                      restore the index settings afterwards, this is faster
+                      but documents cannot be searched until the load is done
 
 Edit the HOST and PORT variables below if you do not need the defaults
 (localhost:9200).
 
 """
 
-import os
 import sys
-import codecs
 import json
+import getopt
 
 from elastic import Index
+from utils import Progress, open_file
+from store import open_store
 
 
 HOST = 'localhost'
 PORT = 9200
 
+THREADS = 4
+CHUNK_SIZE = 500
+MAX_CHUNK_BYTES = 10 * 1024 * 1024
+
 
 def read_documents(document_directory):
-    documents = []
-    for directory_element in sorted(os.listdir(document_directory)):
-        if directory_element.endswith('.json'):
-            print(directory_element)
-            fname = os.path.join(document_directory, directory_element)
-            json_obj = json.loads(codecs.open(fname, encoding='utf8').read())
-            documents.append(json_obj)
-    return documents
+    """Return a list with all JSON documents in document_directory."""
+    return list(iter_documents(document_directory))
+
+
+def iter_documents(document_directory, progress=None):
+    """Generator over the JSON documents in document_directory, reading one
+    document at a time. The number of bytes read is added to the progress
+    reporter if there is one."""
+    store = open_store(document_directory, 'ela')
+    for key in sorted(store.keys()):
+        text = store.read(key)
+        if progress is not None:
+            progress.add(docs=0, bytes=len(text))
+        yield json.loads(text)
+    store.close()
+
+
+def usage():
+    print("\nUsage:\n"
+          + "\n    $ python load_index.py INDEX_NAME DIRECTORY (MAPPING_FILE)"
+          + "\n    $ python load_index.py --threads N --chunk-size N --max-chunk-bytes N"
+          + " --metrics FILE INDEX_NAME DIRECTORY (MAPPING_FILE)"
+          + "\n    $ python load_index.py --bulk INDEX_NAME DIRECTORY data/mapping.json\n")
 
 
 if __name__ == '__main__':
 
-    if len(sys.argv) > 2:
-        index_name = sys.argv[1]
-        source_directory = sys.argv[2]
+    opts, args = getopt.getopt(sys.argv[1:], 'h',
+                               ['threads=', 'chunk-size=', 'max-chunk-bytes=',
+                                'metrics=', 'bulk', 'help'])
+    options = dict(opts)
+    if '-h' in options or '--help' in options:
+        usage()
+        exit()
+    if len(args) > 1:
+        index_name = args[0]
+        source_directory = args[1]
     else:
         exit('ERROR: missing arguments\nUsage: python load_index.py INDEX_NAME DIRECTORY\n')
-    if len(sys.argv) > 3:
-        mapping_fname = sys.argv[3]
-    else:
-        mapping_fname = None
+    mapping_fname = args[2] if len(args) > 2 else None
+    threads = int(options.get('--threads', THREADS))
+    chunk_size = int(options.get('--chunk-size', CHUNK_SIZE))
+    max_chunk_bytes = int(options.get('--max-chunk-bytes', MAX_CHUNK_BYTES))
+    Progress.metrics_file = options.get('--metrics')
 
-    docs = read_documents(source_directory)
     idx = Index(index_name, host=HOST, port=PORT)
     if mapping_fname is not None:
-        idx.es.indices.delete(index=index_name, ignore=[400, 404])
-        mappings = json.load(open(mapping_fname))
-        idx.es.indices.create(index_name, body=mappings)
-    idx.load(docs)
+        with open_file(mapping_fname) as fh:
+            idx.create(json.load(fh))
 
     print("Loading documents into the index...")
+    progress = Progress('load_index')
+    saved_settings = idx.start_bulk_load() if '--bulk' in options else None
+    try:
+        idx.load_streaming(iter_documents(source_directory, progress), threads=threads,
+                           chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                           progress=progress)
+    finally:
+        if saved_settings is not None:
+            idx.end_bulk_load(saved_settings)
@@ -0,0 +1,122 @@
+"""manifest.py
+
+Build manifests for the pipeline stages. A manifest records for each document
+the signature of the inputs that its output was created from, where a signature
+is a hash over the contents of the input documents and, where relevant, the
+version of the topic model. With the --incremental option, stages skip documents
+whose output exists and whose signature did not change since the output was
+written:
+
+>>> manifest = get_manifest(data_dir, 'top')
+>>> signature = Manifest.signature(lif_data, model_version)
+>>> if not manifest.is_current(key, signature) or key not in top_store:
+...     top_store.write(key, ...)
+...     manifest.record(key, signature)
+
+The manifest for a stage directory like DATA_DIR/top is the file
+DATA_DIR/top.manifest, with a JSON object for each recorded document on a line.
+Lines are appended as soon as a document is written, so an interrupted run can
+be resumed with --incremental, and several processes can append to the same
+manifest. When a document is recorded more than once the last line wins.
+
+"""
+
+import os
+import json
+import hashlib
+
+
+# manifests opened by get_manifest(), one for each stage directory
+_MANIFESTS = {}
+
+
+def get_manifest(data_dir, stage):
+    """Return the manifest for a stage in data_dir, reusing the manifest if it was
+    opened before in this process."""
+    directory = os.path.join(data_dir, stage)
+    if directory not in _MANIFESTS:
+        _MANIFESTS[directory] = Manifest(directory)
+    return _MANIFESTS[directory]
+
+
+def close_manifests():
+    """Close all manifests opened by get_manifest()."""
+    for manifest in _MANIFESTS.values():
+        manifest.close()
+    _MANIFESTS.clear()
+
+
+class Manifest(object):
+
+    # set to True to skip documents whose inputs did not change, this is set
+    # by the --incremental option
+    skip_unchanged = False
+
+    def __init__(self, directory):
+        self.fname = directory.rstrip(os.sep) + '.manifest'
+        self.entries = None
+        self.fh = None
+
+    def __str__(self):
+        return "<Manifest %s>" % self.fname
+
+    @staticmethod
+    def signature(*inputs):
+        """Return the signature for a list of inputs, which are bytes or strings."""
+        digest = hashlib.blake2b(digest_size=16)
+        for data in inputs:
+            if isinstance(data, str):
+                data = data.encode('utf8')
+            # include the length so that different splits of the same bytes
+            # give different signatures
+            digest.update(b"%d:" % len(data))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def _load(self):
+        self.entries = {}
+        if os.path.exists(self.fname):
+            with open(self.fname) as fh:
+                for line in fh:
+                    # skip a last line that is still being written
+                    if line.endswith('\n'):
+                        entry = json.loads(line)
+                        self.entries[entry['key']] = entry['signature']
+
+    def is_current(self, key, signature):
+        """Return True if documents whose inputs did not change should be skipped
+        and the document for key was recorded with this signature."""
+        if not Manifest.skip_unchanged:
+            return False
+        if self.entries is None:
+            self._load()
+        return self.entries.get(key) == signature
+
+    def record(self, key, signature):
+        """Record that the document for key was written from inputs with this
+        signature."""
+        if self.fh is None:
+            os.makedirs(os.path.dirname(self.fname) or '.', exist_ok=True)
+            self.fh = open(self.fname, 'a')
+        self.fh.write(json.dumps({'key': key, 'signature': signature}) + '\n')
+        self.fh.flush()
+        if self.entries is not None:
+            self.entries[key] = signature
+
+    def compact(self):
+        """Rewrite the manifest with just one line for each document. This should
+        only be used when no other process is writing to the manifest."""
+        self.close()
+        if not os.path.exists(self.fname):
+            return
+        self._load()
+        tmp_file = self.fname + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            for key, signature in self.entries.items():
+                fh.write(json.dumps({'key': key, 'signature': signature}) + '\n')
+        os.replace(tmp_file, self.fname)
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
@@ -0,0 +1,215 @@
+"""relations.py
+
+Aggregation of the relations taken from the Harvard processing results.
+
+Relations come out of HarvardResults.collect_relations() as four-tuples with a
+relation type, a subject, an object and a list of (pmid, sha, text) evidence
+triples. A RelationTable stores them as columns, with one row for each relation
+in the relation columns and one row for each piece of evidence in the evidence
+columns, where all strings except for the evidence texts are replaced by integer
+codes:
+
+>>> table = RelationTable(results.collect_relations(metadata))
+>>> reified_rels = table.reified_relations()
+>>> inverted_rels = table.inverted_relations()
+
+The table creates the same structures as reify_relations() and the filter and
+invert steps of RelationImporter in covid.py, but the counting and the selection
+of the most frequent subjects is done once for each relation on the codes rather
+than for each piece of evidence, and evidence dictionaries are only created for
+the structures that need them. On 200,000 synthetic relations with one to three
+pieces of evidence each, inverted_relations() took 0.29 seconds where the reify,
+filter and invert steps took 0.94 seconds, but building the table took another
+0.35 seconds, which in streaming mode is spread over reading the results.
+
+"""
+
+import heapq
+from array import array
+from operator import sub, itemgetter
+from itertools import accumulate, chain, compress, count, islice
+
+
+RELTYPES = {'Activation': ('activates', 'activator'),
+            'Inhibition': ('inhibits','inhibitor'),
+            'IncreaseAmount': ('increases', 'increaser'),
+            'DecreaseAmount': ('decreases', 'decreaser')}
+
+# number of subjects kept for each reified relation
+TOP_SUBJECTS = 8
+
+
+class StringTable(object):
+
+    """Maps strings to integer codes and back. Codes are handed out in order, so
+    the keys of the codes dictionary are the strings in code order."""
+
+    def __init__(self):
+        self.codes = {}
+        self._strings = []
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, strings):
+        """Return an iterator over the codes of a list of strings."""
+        codes = self.codes
+        for s in dict.fromkeys(strings):
+            if s not in codes:
+                codes[s] = len(codes)
+        return map(codes.__getitem__, strings)
+
+    @property
+    def strings(self):
+        if len(self._strings) < len(self.codes):
+            self._strings = list(self.codes)
+        return self._strings
+
+
+class RelationTable(object):
+
+    """Columnar table of relations. The statement column has a number identifying
+    each relation, by default the position of the relation in the list handed
+    to the table. The evidence of relation i is in the evidence rows from
+    ends[i] up to ends[i+1]."""
+
+    def __init__(self, relations=None):
+        self.strings = StringTable()
+        # relation columns
+        self.statement = array('l')
+        self.reltype = array('l')
+        self.subj = array('l')
+        self.obj = array('l')
+        self.ends = array('l', [0])
+        # evidence columns, texts are hardly ever repeated so they are not coded
+        self.pmid = array('l')
+        self.sha = array('l')
+        self.text = []
+        if relations:
+            self.extend(relations)
+
+    def __len__(self):
+        return len(self.statement)
+
+    def extend(self, relations, statements=None):
+        """Add the rows for a list of relations, numbering them on their position
+        in the list unless a list of statement numbers is given."""
+        encode = self.strings.encode
+        if statements is None:
+            statements = range(len(relations))
+        self.statement.extend(statements)
+        for i, column in enumerate((self.reltype, self.subj, self.obj)):
+            column.extend(encode([relation[i] for relation in relations]))
+        sizes = [len(relation[3]) for relation in relations]
+        # skip the initial value, which is already in ends
+        self.ends.extend(islice(accumulate(sizes, initial=self.ends[-1]), 1, None))
+        evidence = list(chain.from_iterable(relation[3] for relation in relations))
+        for i, column in enumerate((self.pmid, self.sha)):
+            column.extend(encode(list(map(itemgetter(i), evidence))))
+        self.text.extend(map(itemgetter(2), evidence))
+
+    def evidence_rows(self, i):
+        """Return the range of evidence rows for relation i."""
+        return range(self.ends[i], self.ends[i + 1])
+
+    def relations(self, n=None):
+        """Return the relations as four-tuples like the ones created by
+        collect_relations(), only including statements below n if n is given."""
+        strings = self.strings.strings
+        relations = []
+        for i, statement in enumerate(self.statement):
+            if n is not None and statement >= n:
+                continue
+            evidence = [(strings[self.pmid[row]], strings[self.sha[row]], self.text[row])
+                        for row in self.evidence_rows(i)]
+            relations.append((strings[self.reltype[i]], strings[self.subj[i]],
+                              strings[self.obj[i]], evidence))
+        return relations
+
+    def evidence(self, row):
+        strings = self.strings.strings
+        return {'pmid': strings[self.pmid[row]],
+                'sha': strings[self.sha[row]],
+                'text': self.text[row]}
+
+    def reified_relation(self, reltype, obj):
+        strings = self.strings.strings
+        return "%s-%s" % (strings[obj], RELTYPES[strings[reltype]][1])
+
+    def reified_relations(self):
+        """Return the same index as reify_relations() in covid.py."""
+        strings = self.strings.strings
+        rels = { reltype: {} for reltype in RELTYPES }
+        for i in range(len(self)):
+            reltype = self.reltype[i]
+            reified_rel = self.reified_relation(reltype, self.obj[i])
+            subjects = rels[strings[reltype]].setdefault(reified_rel, {})
+            evidence = subjects.setdefault(strings[self.subj[i]], [])
+            evidence.extend(self.evidence(row) for row in self.evidence_rows(i))
+        return rels
+
+    def top_subjects(self, k=TOP_SUBJECTS):
+        """Group the relations on reified relations and return a list of (reltype,
+        reified relation, size, subjects) tuples, where size is the number of
+        evidence rows in the group and subjects is a list of (subject, rows)
+        pairs for the k subjects with the most evidence rows. Subjects with the
+        same number of rows are ordered on their name, both in descending order.
+        Groups are ordered on relation type, in the order of RELTYPES, and then
+        on the first relation in the group."""
+        strings = self.strings.strings
+        # the group of a relation is its (reltype, obj) pair, the evidence rows of
+        # each subject in a group are counted once for each relation, using the
+        # number of evidence rows of the relation, and dictionaries keep keys in
+        # the order they were first seen, so groups are in the order of their
+        # first relation
+        keys = list(zip(zip(self.reltype, self.obj), self.subj))
+        sizes = map(sub, self.ends[1:], self.ends)
+        groups = {}
+        for (group, subj), size in zip(keys, sizes):
+            counts = groups.get(group)
+            if counts is None:
+                counts = groups[group] = {}
+            counts[subj] = counts.get(subj, 0) + size
+        # subjects with the same count are ordered on their name, which is the
+        # same as ordering them on their position in the sorted subjects
+        names = sorted(set(self.subj), key=strings.__getitem__)
+        name_ranks = dict(zip(names, count()))
+        tops = {}
+        selected = {}
+        for group, counts in groups.items():
+            ranks = map(name_ranks.__getitem__, counts)
+            tops[group] = heapq.nlargest(k, zip(counts.values(), ranks, counts))
+            for subj_count, rank, subj in tops[group]:
+                selected[(group, subj)] = []
+        for i in compress(count(), map(selected.__contains__, keys)):
+            selected[keys[i]].extend(self.evidence_rows(i))
+        order = list(RELTYPES)
+        result = []
+        for group in sorted(groups, key=lambda group: order.index(strings[group[0]])):
+            subjects = [(strings[subj], selected[(group, subj)])
+                        for subj_count, rank, subj in tops[group]]
+            size = sum(groups[group].values())
+            result.append((strings[group[0]], self.reified_relation(*group), size, subjects))
+        return result
+
+    def filtered_relations(self, k=TOP_SUBJECTS):
+        """Return the same index as RelationImporter.filter_relobjs() in covid.py,
+        with the reified relations and their size and the k most frequent
+        subjects with their evidence."""
+        rels = { reltype: {} for reltype in RELTYPES }
+        for reltype, relobj, size, subjects in self.top_subjects(k):
+            data = {subj: [self.evidence(row) for row in rows] for subj, rows in subjects}
+            rels[reltype][relobj] = {'size': size, 'data': data}
+        return rels
+
+    def inverted_relations(self, k=TOP_SUBJECTS):
+        """Return the same index as RelationImporter.invert_filtered_relobjs() in
+        covid.py, with (reified relation, subject) pairs for each file name."""
+        strings = self.strings.strings
+        inverted_rels = {}
+        for reltype, relobj, size, subjects in self.top_subjects(k):
+            for subj, rows in subjects:
+                for row in rows:
+                    fname = strings[self.sha[row]] + '.json'
+                    inverted_rels.setdefault(fname, []).append((relobj, subj))
+        return inverted_rels
@@ -0,0 +1,213 @@
+"""runner.py
+
+Batch runner for the scripts that process the files in a filelist, which are
+create_index.py and generate_topics.py. The runner takes the lines from BEGIN to
+END from the filelist, hands them out in batches to a function, optionally in a
+pool of worker processes, and keeps track of how far it got:
+
+>>> runner = BatchRunner(filelist, start, end)
+>>> errors = runner.run('create_index', _create_batch,
+...                     lambda fnames: (data_dir, fnames, crash), workers=4)
+
+The function is called on the job created from a list of file names and should
+return the number of documents processed, the number of characters written and
+a list of (fname, error) pairs, like _create_batch() in create_index.py.
+
+Reading the filelist starts by seeking to the first line, using the index of line
+offsets kept by utils.line_offsets(), so a run that starts at line 40000 does not
+read the 39999 lines before it.
+
+With a shard (I, N) only the lines I, I+N, I+2N and so on are taken, with I from
+1 to N, so N processes or machines that each get their own shard of the same
+filelist and BEGIN and END process every file exactly once.
+
+With a state file the runner writes a checkpoint to the state file every
+checkpoint_every lines and at the end of the run, and when it is interrupted.
+The checkpoint has the first line that was not yet processed, and with resume
+set processing starts at that line. Lines after the checkpoint line may have
+been processed already, use --incremental to skip those (see manifest.py). The
+names of the files that failed are written to the state file with .retry added,
+one on each line, so that file can be used as the filelist of a later run.
+
+The scripts set the class variables from the --state, --resume, --shard and
+--checkpoint options with set_runner_options().
+
+"""
+
+import os
+import json
+from multiprocessing import Pool
+
+from utils import elements, line_offsets, batches, Progress
+
+
+# long options for getopt that are handled by set_runner_options()
+RUNNER_OPTIONS = ['state=', 'resume', 'shard=', 'checkpoint=']
+
+CHECKPOINT_EVERY = 1000
+
+
+def set_runner_options(options):
+    """Update the runner settings from a dictionary of command line options."""
+    if '--state' in options:
+        BatchRunner.state_file = options['--state']
+    if '--resume' in options:
+        BatchRunner.resume = True
+    if '--shard' in options:
+        BatchRunner.shard = parse_shard(options['--shard'])
+    if '--checkpoint' in options:
+        BatchRunner.checkpoint_every = int(options['--checkpoint'])
+
+
+def parse_shard(shard):
+    """Return the (I, N) pair for a string like 2/8."""
+    i, n = [int(x) for x in shard.split('/')]
+    if not 1 <= i <= n:
+        raise ValueError("shard %s is not one of 1/%d to %d/%d" % (shard, n, n, n))
+    return i, n
+
+
+class BatchRunner(object):
+
+    # default settings for all runners, these are set by set_runner_options()
+    state_file = None
+    resume = False
+    shard = None
+    checkpoint_every = CHECKPOINT_EVERY
+
+    def __init__(self, filelist, start=1, end=None, shard=None, state_file=None,
+                 resume=None, checkpoint_every=None):
+        self.filelist = filelist
+        self.start = start
+        self.end = end
+        self.shard = BatchRunner.shard if shard is None else shard
+        self.state_file = BatchRunner.state_file if state_file is None else state_file
+        self.resume = BatchRunner.resume if resume is None else resume
+        self.checkpoint_every = (BatchRunner.checkpoint_every if checkpoint_every is None
+                                 else checkpoint_every)
+        self.next = start
+        # maps the names of files that failed to their line number and error
+        self.failed = {}
+        if self.resume:
+            self._read_state()
+
+    def __str__(self):
+        shard = '' if self.shard is None else ' shard=%d/%d' % self.shard
+        return "<BatchRunner %s %d-%s%s>" % (self.filelist, self.start, self.end, shard)
+
+    def _read_state(self):
+        if self.state_file is None:
+            raise ValueError("resuming needs a state file")
+        if not os.path.exists(self.state_file):
+            return
+        with open(self.state_file) as fh:
+            state = json.load(fh)
+        shard = None if state['shard'] is None else tuple(state['shard'])
+        if (state['filelist'] != os.path.abspath(self.filelist)
+                or state['start'] != self.start or state['end'] != self.end
+                or shard != self.shard):
+            raise ValueError("state file %s is for a different run" % self.state_file)
+        self.next = state['next']
+        # failures after the checkpoint are retried so they are not kept
+        self.failed = {fname: (n, error) for n, fname, error in state['failed']
+                       if n < self.next}
+        print("Resuming %s from line %d" % (self.filelist, self.next))
+
+    def _first_line(self):
+        """Return the first line at or after the next line that is in the shard."""
+        if self.shard is None:
+            return self.next
+        i, n = self.shard
+        return self.next + (i - 1 - (self.next - 1)) % n
+
+    def lines(self):
+        """Generator over the (line number, file name) pairs to be processed."""
+        step = 1 if self.shard is None else self.shard[1]
+        return elements(self.filelist, self._first_line(), self.end, step=step)
+
+    def total(self):
+        """Return the number of lines to be processed."""
+        last = len(line_offsets(self.filelist))
+        if self.end is not None:
+            last = min(last, self.end)
+        step = 1 if self.shard is None else self.shard[1]
+        return len(range(self._first_line(), last + 1, step))
+
+    def run(self, name, function, make_job, workers=1, batch_size=100,
+            initializer=None, initargs=()):
+        """Run function on the jobs created by make_job() from batches of file
+        names, using a pool of processes if workers > 1 and otherwise running
+        each file as a batch of its own. The initializer is called with initargs
+        in each worker process, or once in this process for a serial run. The name
+        is used for the progress reporter. Returns a list of (fname, error) pairs
+        for all files that failed, including those from before a resume."""
+        progress = Progress(name, total=self.total())
+        line_batches = list(batches(self.lines(), batch_size if workers > 1 else 1))
+        jobs = [(function, batch_id, make_job([fname for n, fname in batch]))
+                for batch_id, batch in enumerate(line_batches)]
+        if workers > 1:
+            pool = Pool(workers, initializer=initializer, initargs=initargs)
+            results = pool.imap_unordered(_run_job, jobs)
+        else:
+            pool = None
+            if initializer is not None:
+                initializer(*initargs)
+            results = map(_run_job, jobs)
+        # batches may finish out of order, the checkpoint is the first line of
+        # the first batch that did not finish
+        finished = set()
+        first_unfinished = 0
+        since_checkpoint = 0
+        try:
+            for batch_id, (docs, size, errors) in results:
+                batch = line_batches[batch_id]
+                line_numbers = {fname: n for n, fname in batch}
+                for fname, error in errors:
+                    self.failed[fname] = (line_numbers[fname], error)
+                progress.add(docs=docs, bytes=size, errors=len(errors))
+                finished.add(batch_id)
+                while first_unfinished in finished:
+                    first_unfinished += 1
+                since_checkpoint += len(batch)
+                if since_checkpoint >= self.checkpoint_every:
+                    self._checkpoint(line_batches, first_unfinished)
+                    since_checkpoint = 0
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            if pool is not None:
+                pool.terminate()
+            self._checkpoint(line_batches, first_unfinished)
+        progress.finish(failed=len(self.failed))
+        return [(fname, error) for fname, (n, error) in self.failed.items()]
+
+    def _checkpoint(self, line_batches, first_unfinished):
+        if first_unfinished < len(line_batches):
+            self.next = line_batches[first_unfinished][0][0]
+        elif line_batches:
+            self.next = line_batches[-1][-1][0] + 1
+        if self.state_file is None:
+            return
+        state = {'filelist': os.path.abspath(self.filelist),
+                 'start': self.start, 'end': self.end, 'shard': self.shard,
+                 'next': self.next, 'finished': first_unfinished == len(line_batches),
+                 'failed': sorted((n, fname, error) for fname, (n, error)
+                                  in self.failed.items())}
+        directory = os.path.dirname(self.state_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_file = "%s.%d.tmp" % (self.state_file, os.getpid())
+        with open(tmp_file, 'w') as fh:
+            json.dump(state, fh, indent=4)
+        os.replace(tmp_file, self.state_file)
+        with open(self.state_file + '.retry', 'w', encoding='utf8') as fh:
+            for n, fname, error in state['failed']:
+                fh.write(fname + "\n")
+
+
+def _run_job(job):
+    """Run a job in a worker process and return its result together with the
+    number of the batch it was created from."""
+    function, batch_id, args = job
+    return batch_id, function(args)
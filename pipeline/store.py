@@ -0,0 +1,246 @@
+"""store.py
+
+Storage for the documents created by the pipeline stages. There are two kinds of
+stores, both keyed on the document identifier (the sha of the paper):
+
+DirectoryStore   one file per document in a directory, this is the original
+                 layout with files like lif/SHA.json and har/SHA.lif
+PackedStore      documents appended to a few large shard files with an offset
+                 index, documents are read through mmap
+
+A packed store is a directory with a marker file named PACKED and pairs of files
+SHARD.pack and SHARD.idx. Each line in the index file has a key, an offset and a length. Shards are only ever
+appended to, and each writing process creates its own shards, so several
+processes can write to the same store at the same time. When a key occurs more
+than once the latest entry wins. Records are compressed when the --gzip option
+is used.
+
+Use open_store() to get a store for one of the pipeline stages:
+
+>>> lif_store = open_store(os.path.join(data_dir, 'lif'), 'lif')
+>>> lif = LIF.from_store(lif_store, sha)
+
+The kind of store is determined by what is on disk, new stores are packed if the
+--packed option was given to the script. A new packed store is created on disk
+in one step, so processes that open the same new store at the same time, like
+the workers of a pool, all get the same kind of store.
+
+"""
+
+import os
+import gzip
+import mmap
+import time
+import shutil
+import threading
+
+from utils import OUTPUT, open_file, find_file, file_exists, strip_gz, json_dumps, write_json
+
+
+# file extensions used in the directory layout
+EXTENSIONS = {'lif': '.json', 'har': '.lif', 'top': '.lif', 'ela': '.json'}
+
+# size at which a writer starts a new shard
+SHARD_SIZE = 1024 * 1024 * 1024
+
+# name of the file that marks a directory as a packed store
+PACKED_MARKER = 'PACKED'
+
+# stores opened by get_store(), one for each directory and stage
+_STORES = {}
+
+
+def open_store(directory, stage):
+    """Return the store for a pipeline stage (one of lif, har, top or ela) in
+    directory. The store is packed if the directory already holds a packed
+    store or if the directory does not exist yet and the packed output
+    setting is on. A new packed store is created on disk right away and in one
+    step, so processes that open the store at the same time or later agree on
+    its kind."""
+    # a packed store directory never exists without the marker, so checking for
+    # the directory first and then for the marker cannot miss a packed store
+    # that another process creates in between
+    if os.path.exists(directory):
+        packed = is_packed_store(directory)
+    else:
+        packed = OUTPUT.get('packed')
+    if packed:
+        return PackedStore(directory)
+    return DirectoryStore(directory, EXTENSIONS[stage])
+
+
+def get_store(data_dir, stage):
+    """Return the store for a stage in data_dir, reusing the store if it was
+    opened before in this process."""
+    directory = os.path.join(data_dir, stage)
+    if (directory, stage) not in _STORES:
+        _STORES[(directory, stage)] = open_store(directory, stage)
+    return _STORES[(directory, stage)]
+
+
+def close_stores():
+    """Close all stores opened by get_store()."""
+    for store in _STORES.values():
+        store.close()
+    _STORES.clear()
+
+
+def document_key(fname):
+    """Return the store key for a file name from a filelist, which is the name
+    without directories and extensions."""
+    return os.path.basename(fname).split('.')[0]
+
+
+def is_packed_store(directory):
+    return os.path.exists(os.path.join(directory, PACKED_MARKER))
+
+
+def create_packed_store(directory):
+    """Create the directory for a packed store with the marker in it, unless some
+    other process created it first. The directory is set up under a temporary
+    name and then renamed, so other processes never see it without the
+    marker and take it for a directory store."""
+    tmp_dir = "%s.%d-%d.tmp" % (directory.rstrip(os.sep), os.getpid(), threading.get_ident())
+    os.makedirs(tmp_dir)
+    open(os.path.join(tmp_dir, PACKED_MARKER), 'w').close()
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        shutil.rmtree(tmp_dir)
+        if not is_packed_store(directory):
+            raise
+
+
+class DirectoryStore(object):
+
+    def __init__(self, directory, extension):
+        self.directory = directory
+        self.extension = extension
+
+    def __str__(self):
+        return "<DirectoryStore %s>" % self.directory
+
+    def __contains__(self, key):
+        return file_exists(self.path(key))
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.extension)
+
+    def keys(self):
+        keys = []
+        for fname in os.listdir(self.directory):
+            fname = strip_gz(fname)
+            if fname.endswith(self.extension):
+                keys.append(fname[:-len(self.extension)])
+        return keys
+
+    def read(self, key):
+        """Return the document for key as bytes."""
+        with open_file(find_file(self.path(key)), 'rb') as fh:
+            return fh.read()
+
+    def write(self, key, json_obj, newline=False):
+        """Write the document for key using the output settings and return the
+        number of characters written."""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        return write_json(json_obj, self.path(key), newline=newline)
+
+    def close(self):
+        pass
+
+
+class PackedStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = {}
+        self.maps = {}
+        self.shard = None
+        self.pack_fh = None
+        self.idx_fh = None
+        self.offset = 0
+        if not is_packed_store(directory):
+            create_packed_store(directory)
+        self._load_index()
+
+    def __str__(self):
+        return "<PackedStore %s with %d documents>" % (self.directory, len(self.index))
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def _load_index(self):
+        # shard names start with a timestamp so sorting them gives the order in
+        # which they were created and later entries overwrite earlier ones
+        for fname in sorted(os.listdir(self.directory)):
+            if fname.endswith('.idx'):
+                shard = fname[:-4]
+                with open(os.path.join(self.directory, fname)) as fh:
+                    for line in fh:
+                        fields = line.split('\t')
+                        # skip a last line that is still being written
+                        if len(fields) == 3 and line.endswith('\n'):
+                            self.index[fields[0]] = (shard, int(fields[1]), int(fields[2]))
+
+    def read(self, key):
+        """Return the document for key as bytes."""
+        shard, offset, length = self.index[key]
+        data = self._map(shard, offset + length)[offset:offset + length]
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        return data
+
+    def _map(self, shard, size):
+        """Return a memory map for a shard that covers at least size bytes."""
+        mapped = self.maps.get(shard)
+        if mapped is None or len(mapped) < size:
+            if shard == self.shard:
+                self.pack_fh.flush()
+            with open(os.path.join(self.directory, shard + '.pack'), 'rb') as fh:
+                mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[shard] = mapped
+        return mapped
+
+    def write(self, key, json_obj, newline=False):
+        """Append the document for key to the current shard of this writer and
+        return the number of characters written."""
+        s = json_dumps(json_obj) + ("\n" if newline else '')
+        data = s.encode('utf8')
+        if OUTPUT['gzip']:
+            data = gzip.compress(data)
+        if self.shard is None or self.offset + len(data) > SHARD_SIZE:
+            self._new_shard()
+        self.pack_fh.write(data)
+        self.pack_fh.flush()
+        self.idx_fh.write("%s\t%d\t%d\n" % (key, self.offset, len(data)))
+        self.idx_fh.flush()
+        self.index[key] = (self.shard, self.offset, len(data))
+        self.offset += len(data)
+        return len(s)
+
+    def _new_shard(self):
+        self.close()
+        self.shard = "%s-%06d" % (time.strftime("%Y%m%d%H%M%S"), os.getpid())
+        while os.path.exists(os.path.join(self.directory, self.shard + '.pack')):
+            self.shard += 'x'
+        self.pack_fh = open(os.path.join(self.directory, self.shard + '.pack'), 'wb')
+        self.idx_fh = open(os.path.join(self.directory, self.shard + '.idx'), 'w')
+        self.offset = 0
+
+    def close(self):
+        if self.pack_fh is not None:
+            self.pack_fh.close()
+            self.idx_fh.close()
+            self.pack_fh = None
+            self.idx_fh = None
+            self.shard = None
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps = {}
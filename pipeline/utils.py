@@ -1,44 +1,209 @@
 import os
 import sys
 import time
+import json
+import gzip
 import getopt
+from array import array
+
+from manifest import Manifest
+
+
+# Output settings for files written by the pipeline scripts. By default JSON is
+# pretty-printed, not compressed and written to one file per document, the
+# --compact, --gzip and --packed options of the scripts change these settings.
+OUTPUT = {'pretty': True, 'gzip': False, 'packed': False}
 
 
 def get_options():
-    """Default method for getting options."""
-    options = dict(getopt.getopt(sys.argv[1:], 'd:f:b:e:', ['crash'])[0])
+    """Default method for getting options. The --metrics, --compact, --gzip,
+    --packed and --incremental options are not returned but set the file that
+    all progress reporters write metrics to, the output settings and whether
+    documents with unchanged inputs are skipped. The --state, --resume, --shard
+    and --checkpoint options set the defaults of the batch runner (see
+    runner.py)."""
+    # imported here because the runner module imports from this module
+    from runner import RUNNER_OPTIONS, set_runner_options
+    options = dict(getopt.getopt(sys.argv[1:], 'd:f:b:e:',
+                                 ['crash', 'metrics=', 'workers=', 'compact', 'gzip',
+                                  'packed', 'incremental'] + RUNNER_OPTIONS)[0])
     data_dir = options.get('-d')
     filelist = options.get('-f', 'files-random.txt')
     start = int(options.get('-b', 1))
     end = int(options.get('-e', 1))
     crash = True if '--crash' in options else False
-    return data_dir, filelist, start, end, crash
+    workers = int(options.get('--workers', 1))
+    Progress.metrics_file = options.get('--metrics')
+    set_output_options(options)
+    set_runner_options(options)
+    Manifest.skip_unchanged = '--incremental' in options
+    return data_dir, filelist, start, end, crash, workers
+
+
+def get_settings():
+    """Return the settings that command line options store in module and class
+    variables, which are the output settings, the metrics file and whether
+    documents with unchanged inputs are skipped. Worker processes only inherit
+    these when they are forked, so pool initializers get them as an argument
+    and hand them to apply_settings(), which also works when workers are
+    spawned, as they are by default on macOS and Windows."""
+    return dict(OUTPUT), Progress.metrics_file, Manifest.skip_unchanged
+
+
+def apply_settings(settings):
+    """Set the settings returned by get_settings()."""
+    output, metrics_file, skip_unchanged = settings
+    OUTPUT.update(output)
+    Progress.metrics_file = metrics_file
+    Manifest.skip_unchanged = skip_unchanged
+
+
+def set_output_options(options):
+    """Update the output settings from a dictionary of command line options."""
+    if '--compact' in options:
+        OUTPUT['pretty'] = False
+    if '--gzip' in options:
+        OUTPUT['gzip'] = True
+    if '--packed' in options:
+        OUTPUT['packed'] = True
+
+
+def open_file(fname, mode='r'):
+    """Open a file for reading or writing, using gzip if the file name ends in
+    .gz. Text modes use UTF-8."""
+    if fname.endswith('.gz'):
+        if 'b' in mode:
+            return gzip.open(fname, mode)
+        return gzip.open(fname, mode + 't', encoding='utf8')
+    if 'b' in mode:
+        return open(fname, mode)
+    return open(fname, mode, encoding='utf8')
+
+
+def find_file(fname):
+    """Return fname if it exists, or its gzipped version if that exists. Returns
+    fname if neither exists."""
+    if not os.path.exists(fname) and os.path.exists(fname + '.gz'):
+        return fname + '.gz'
+    return fname
+
+
+def file_exists(fname):
+    """Return True if fname or its gzipped version exists."""
+    return os.path.exists(find_file(fname))
+
+
+def strip_gz(fname):
+    return fname[:-3] if fname.endswith('.gz') else fname
+
+
+def output_file(fname):
+    """Return the name that fname is written to with the current output settings,
+    which adds .gz if output is compressed."""
+    if OUTPUT['gzip'] and not fname.endswith('.gz'):
+        return fname + '.gz'
+    return fname
+
+
+def json_dumps(json_obj, pretty=None):
+    """Return a JSON string for json_obj, pretty-printed or compact depending on
+    the pretty argument or on the output settings if pretty is None."""
+    if pretty is None:
+        pretty = OUTPUT['pretty']
+    if pretty:
+        return json.dumps(json_obj, sort_keys=True, indent=4, separators=(',', ': '))
+    return json.dumps(json_obj, sort_keys=True, separators=(',', ':'))
+
+
+def write_json(json_obj, fname, newline=False):
+    """Write json_obj to fname using the output settings, so the file may be
+    compressed and have .gz added to its name. Returns the number of
+    characters written."""
+    s = json_dumps(json_obj)
+    if newline:
+        s += "\n"
+    with open_file(output_file(fname), 'w') as fh:
+        fh.write(s)
+    return len(s)
 
 
 def time_elapsed(fun):
     """Function to be used as a decorator for measuring time elapsed."""
     def wrapper(*args, **kwargs):
         t0 = time.time()
-        fun(*args, **kwargs)
+        result = fun(*args, **kwargs)
         print("\nTime elapsed = %s" % (time.time() - t0))
+        return result
     return wrapper
 
 
-def elements(filelist, start, end):
-    """Generator over the lines in filelist, only yielding lines from line niumber
-    start up to and including end."""
-    process = False
-    n = 1
-    with open(filelist) as fh:
+def elements(filelist, start, end=None, step=1):
+    """Generator over the lines in filelist, only yielding lines from line number
+    start up to and including end, or up to the last line if end is None. With
+    step > 1 only every step-th of those lines is yielded. The filelist is not
+    read from the beginning, instead this seeks to the offsets of the lines,
+    which are taken from line_offsets()."""
+    if start < 1:
+        raise ValueError("line numbers start at 1, not at %d" % start)
+    return _elements(filelist, start, end, step)
+
+
+def _elements(filelist, start, end, step):
+    offsets = line_offsets(filelist)
+    last = len(offsets) if end is None else min(end, len(offsets))
+    if start > last:
+        return
+    with open(filelist, 'rb') as fh:
+        fh.seek(offsets[start - 1])
+        for n in range(start, last + 1, step):
+            if step > 1:
+                fh.seek(offsets[n - 1])
+            yield (n, fh.readline().decode('utf8').strip())
+
+
+# line offsets of filelists, keyed on file name, size and modification time
+_LINE_OFFSETS = {}
+
+
+def line_offsets(filelist):
+    """Return an array with the byte offset of each line in filelist. The array is
+    kept for as long as the process runs, so a filelist is only read again when
+    its size or modification time changes."""
+    stat = os.stat(filelist)
+    key = (os.path.abspath(filelist), stat.st_size, stat.st_mtime_ns)
+    if key not in _LINE_OFFSETS:
+        _LINE_OFFSETS[key] = _read_line_offsets(filelist)
+    return _LINE_OFFSETS[key]
+
+
+def _read_line_offsets(filelist):
+    offsets = array('q')
+    offset = 0
+    with open(filelist, 'rb') as fh:
         for line in fh:
-            fname = line.strip()
-            if n == start:
-                process = True
-            if n > end:
-                return
-            if process:
-                yield (n, fname)
-            n += 1
+            offsets.append(offset)
+            offset += len(line)
+    return offsets
+
+
+def batches(iterable, size):
+    """Generator over lists of at most size elements taken from iterable."""
+    batch = []
+    for element in iterable:
+        batch.append(element)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def print_errors(errors):
+    """Print a summary of a list of (fname, error) pairs."""
+    if errors:
+        print("\nErrors in %d files:\n" % len(errors))
+        for fname, error in errors:
+            print("    %s  %s" % (fname, error))
 
 
 def print_element(n, fname):
@@ -53,3 +218,80 @@ def ensure_directory(*fnames):
             os.makedirs(directory)
 
 
+class Progress(object):
+
+    """Progress and metrics reporter for long running loops. Keeps counters for
+    documents, bytes, errors and retries and prints a progress line with rates
+    at most once every interval seconds. If metrics_file is set, every report
+    is also appended to that file as a JSON line. Set the metrics_file class
+    variable to have all reporters write to the same file, which is what the
+    --metrics option of the scripts does.
+
+    >>> progress = Progress('create_index', total=1000)
+    >>> for fname in fnames:
+    ...     progress.add(docs=1, bytes=size)
+    >>> progress.finish()
+
+    """
+
+    metrics_file = None
+
+    def __init__(self, name, total=None, interval=5.0, metrics_file=None, stream=None):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.stream = sys.stdout if stream is None else stream
+        fname = Progress.metrics_file if metrics_file is None else metrics_file
+        self.metrics_fh = None if fname is None else open(fname, 'a', encoding='utf8')
+        self.docs = 0
+        self.bytes = 0
+        self.errors = 0
+        self.retries = 0
+        self.t0 = time.time()
+        self.last_line = self.t0
+
+    def add(self, docs=1, bytes=0, errors=0, retries=0):
+        """Update the counters and print a progress line if it is time to do so."""
+        self.docs += docs
+        self.bytes += bytes
+        self.errors += errors
+        self.retries += retries
+        if time.time() - self.last_line >= self.interval:
+            self.report()
+
+    def metrics(self, **extra):
+        elapsed = time.time() - self.t0
+        metrics = {'name': self.name, 'time': round(time.time(), 3),
+                   'elapsed': round(elapsed, 3), 'docs': self.docs,
+                   'bytes': self.bytes, 'errors': self.errors, 'retries': self.retries,
+                   'docs_per_sec': round(self.docs / elapsed, 2) if elapsed else 0.0,
+                   'bytes_per_sec': round(self.bytes / elapsed, 2) if elapsed else 0.0}
+        metrics.update(extra)
+        return metrics
+
+    def report(self, force=True, **extra):
+        """Write a metrics record to the metrics file and print a progress line. If
+        force is False the line is only printed if the last one was printed at
+        least interval seconds ago. Any keyword arguments are added to the
+        metrics record."""
+        metrics = self.metrics(**extra)
+        if self.metrics_fh is not None:
+            self.metrics_fh.write(json.dumps(metrics) + "\n")
+        if force or time.time() - self.last_line >= self.interval:
+            self.last_line = time.time()
+            total = '' if self.total is None else '/%d' % self.total
+            self.stream.write(
+                "%s  %s  %d%s docs  %.1f docs/sec  %.1f KB/sec  %d errors  %d retries\n"
+                % (time.strftime("%Y%m%d:%H%M%S"), self.name, self.docs, total,
+                   metrics['docs_per_sec'], metrics['bytes_per_sec'] / 1024,
+                   self.errors, self.retries))
+            self.stream.flush()
+        return metrics
+
+    def finish(self, **extra):
+        """Print a final report and close the metrics file."""
+        metrics = self.report(final=True, **extra)
+        if self.metrics_fh is not None:
+            self.metrics_fh.close()
+            self.metrics_fh = None
+        return metrics